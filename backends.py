@@ -0,0 +1,649 @@
+import os
+import json
+import math
+import time
+import random
+import threading
+from search_stats import report_server_timings, report_overload
+
+# (connect, read) timeouts applied to every backend request
+REQUEST_TIMEOUT = (float(os.getenv('LLAMA_CONNECT_TIMEOUT', 5)), float(os.getenv('LLAMA_REQUEST_TIMEOUT', 120)))
+
+# A server answering 429 or 503 is full rather than broken: the request is retried up to LLOOM_RETRIES
+# times, waiting LLOOM_RETRY_BACKOFF seconds doubled on every attempt (or what Retry-After says, when that
+# is between 0 and LLOOM_RETRY_AFTER_MAX seconds, since the wait holds a worker and its request slot)
+LLOOM_RETRIES = int(os.getenv('LLOOM_RETRIES', 3))
+LLOOM_RETRY_BACKOFF = float(os.getenv('LLOOM_RETRY_BACKOFF', 0.5))
+LLOOM_RETRY_AFTER_MAX = float(os.getenv('LLOOM_RETRY_AFTER_MAX', 30))
+RETRY_STATUS = (429, 503)
+
+# How many alternatives to ask for per token, clipped to what the backend can return
+LLOOM_TOP_K = os.getenv('LLOOM_TOP_K')
+
+# One keep-alive connection pool shared by every backend and every search thread,
+# grown to match the largest parallelism a search has asked for.
+http_session = None
+http_pool_size = 0
+http_lock = threading.Lock()
+
+def get_http_session(pool_size=None):
+    global http_session, http_pool_size
+    with http_lock:
+        if http_session is None or (pool_size is not None and pool_size > http_pool_size):
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            http_pool_size = max(pool_size or 1, http_pool_size, 1)
+            # pool_block makes surplus threads wait for a free connection instead of opening throwaway sockets
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_pool_size, pool_block=True)
+            session = requests.Session()
+            session.headers.update({'Connection': 'keep-alive'})
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # the old session is left for in-flight requests to finish on, it is released once they drop it
+            http_session = session
+        return http_session
+
+openai_client = None
+openai_pool_size = 0
+def get_openai_client(pool_size=None):
+    global openai_client, openai_pool_size
+    with http_lock:
+        if openai_client is None or (pool_size is not None and pool_size > openai_pool_size):
+            import httpx
+            from openai import OpenAI
+
+            openai_pool_size = max(pool_size or 1, openai_pool_size, 1)
+            limits = httpx.Limits(max_connections=openai_pool_size, max_keepalive_connections=openai_pool_size)
+            timeout = httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0])
+            # the OpenAI client does its own backoff on 429s, given the same number of tries
+            openai_client = OpenAI(http_client=httpx.Client(limits=limits, timeout=timeout), max_retries=LLOOM_RETRIES)
+        return openai_client
+
+def retry_delay(attempt, retry_after=None):
+    try:
+        delay = float(retry_after)
+        if 0 <= delay <= LLOOM_RETRY_AFTER_MAX:
+            return delay
+    except (TypeError, ValueError):
+        pass
+    # jittered so requests turned away together don't all come back together
+    return LLOOM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+
+def post_retrying(url, payload):
+    for attempt in range(LLOOM_RETRIES + 1):
+        response = get_http_session().post(url, json=payload, timeout=REQUEST_TIMEOUT)
+        if response.status_code not in RETRY_STATUS or attempt == LLOOM_RETRIES:
+            return response
+        report_overload()
+        time.sleep(retry_delay(attempt, response.headers.get('Retry-After')))
+
+async def async_post_retrying(session, url, payload):
+    # the response is used as `async with` like session.post's
+    import asyncio
+
+    for attempt in range(LLOOM_RETRIES + 1):
+        response = await session.post(url, json=payload)
+        if response.status not in RETRY_STATUS or attempt == LLOOM_RETRIES:
+            return response
+        response.release()
+        report_overload()
+        await asyncio.sleep(retry_delay(attempt, response.headers.get('Retry-After')))
+
+class SimpleProbability:
+    def __init__(self, token, probability, token_id=None):
+        self.token = token
+        self.probability = probability
+        self.token_id = token_id
+
+def is_token_prompt(prompt):
+    # a token id array, or a batch of them
+    return isinstance(prompt, list) and len(prompt) > 0 and isinstance(prompt[0], (int, list))
+
+def parse_llama_position(position):
+    if 'probs' in position:
+        return [ SimpleProbability(prob['tok_str'], prob['prob']) for prob in position['probs'] ]
+    if 'top_logprobs' in position:
+        # newer servers report log-probabilities along with token ids
+        return [ SimpleProbability(prob['token'], math.exp(prob['logprob']), prob.get('id')) for prob in position['top_logprobs'] ]
+    print("Warning: 'probs' key not found in the completion probability.")
+    return None
+
+def parse_llama_positions(response_json):
+    # one next-token distribution per generated token, None for a failed request so it isn't mistaken
+    # for a distribution (and cached as one)
+    try:
+        if 'completion_probabilities' in response_json and response_json['completion_probabilities']:
+            positions = [ parse_llama_position(position) for position in response_json['completion_probabilities'] ]
+            # a continuation is only good up to the first position that couldn't be read
+            if None in positions:
+                positions = positions[:positions.index(None)]
+            return positions or None
+        print("Warning: 'completion_probabilities' is empty or not present in the response.")
+    except KeyError as e:
+        print(f"Error: Expected key not found in JSON response: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+    return None
+
+def parse_llama_probs(response_json):
+    positions = parse_llama_positions(response_json)
+    return positions[0] if positions else None
+
+def llama_pre_sampling(response_json):
+    # True if the server answered in the top_logprobs format, whose probabilities are taken before sampling,
+    # False for the older probs format, which may report them after, None when the response doesn't tell
+    results = response_json if isinstance(response_json, list) else [response_json]
+    for result in results:
+        if isinstance(result, dict) and result.get('completion_probabilities'):
+            return 'top_logprobs' in result['completion_probabilities'][0]
+    return None
+
+def llama_server_ms(response_json):
+    # llama.cpp reports how long it spent on prompt processing and generation, a batch is served concurrently
+    results = response_json if isinstance(response_json, list) else [response_json]
+    timings = [ result['timings'].get('prompt_ms', 0) + result['timings'].get('predicted_ms', 0) for result in results if isinstance(result, dict) and 'timings' in result ]
+    return max(timings) if timings else None
+
+def parse_llama_batch(response_json, count, parse=parse_llama_probs):
+    # a multi-prompt /completion answers with one result per prompt
+    if isinstance(response_json, dict):
+        response_json = [response_json]
+    results = sorted(response_json, key=lambda result: result.get('index', 0)) if all('index' in result for result in response_json) else response_json
+    if len(results) != count:
+        print(f"Warning: sent {count} prompts but got {len(results)} results.")
+        results = (results + [{}] * count)[:count]
+    return [ parse(result) for result in results ]
+
+def parse_vllm_probs(response_json, index=0):
+    choice = [choice for choice in response_json['choices'] if choice.get('index', 0) == index][0]
+    probs = choice['logprobs']['top_logprobs'][0]
+    logprobs = []
+    for k,v in probs.items():
+        if k.startswith('token_id:'):
+            # text is filled in by resolve_tokens
+            logprobs.append(SimpleProbability(None, math.exp(v), int(k[len('token_id:'):])))
+        else:
+            logprobs.append(SimpleProbability(k,math.exp(v)))
+    # the top_logprobs object isn't guaranteed to be in probability order
+    return sorted(logprobs, key=lambda logprob: logprob.probability, reverse=True)
+
+class Backend:
+    # Registry name, the environment variable that selects it and its capabilities.
+    name = None
+    env = None
+    max_top_k = 10
+    default_top_k = 10
+    supports_batching = False
+    supports_token_ids = False
+    # can return the distributions along a short greedy continuation in one request
+    supports_continuation = False
+
+    def __init__(self, base_url=None, top_k=None):
+        self.base_url = base_url
+        self.top_k = min(int(top_k or self.default_top_k), self.max_top_k)
+        self.model = None
+        self.signature = None
+        self.lock = threading.Lock()
+
+    def open(self, pool_size):
+        # size the shared connection pool so every worker thread gets its own kept-alive socket
+        get_http_session(pool_size)
+
+    def model_name(self):
+        # resolved from the server once per backend
+        with self.lock:
+            if self.model is None:
+                self.model = self.fetch_model_name()
+            return self.model
+
+    def fetch_model_name(self):
+        return ""
+
+    def display_name(self):
+        # model name as used in output file names
+        modelname, extension = os.path.splitext(os.path.basename(self.model_name()))
+        return modelname
+
+    def sampling_params(self):
+        return {}
+
+    def cache_signature(self):
+        # (backend, model, sampling params) that a cached logprob is only valid for
+        if self.signature is None:
+            self.signature = (self.name+':'+str(self.base_url), self.model_name(), self.sampling_params())
+        return self.signature
+
+    def get_logprobs(self, prompt):
+        raise NotImplementedError
+
+    def get_logprobs_batch(self, prompts):
+        return [ self.get_logprobs(prompt) for prompt in prompts ]
+
+    def get_continuation_batch(self, prompts, length):
+        # per prompt the next-token distribution at each of `length` greedy tokens, or just the first
+        return [ [logprobs] for logprobs in self.get_logprobs_batch(prompts) ]
+
+    def tokenize(self, text):
+        raise NotImplementedError
+
+    def async_session(self, concurrency):
+        # the client the async_* methods are handed, used as `async with`
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=REQUEST_TIMEOUT[0], sock_read=REQUEST_TIMEOUT[1])
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def async_get_logprobs(self, session, prompt):
+        raise NotImplementedError
+
+    async def async_get_logprobs_batch(self, session, prompts):
+        return [ await self.async_get_logprobs(session, prompt) for prompt in prompts ]
+
+    async def async_get_continuation_batch(self, session, prompts, length):
+        return [ [logprobs] for logprobs in await self.async_get_logprobs_batch(session, prompts) ]
+
+    @classmethod
+    def from_env(cls):
+        if cls.env is not None and os.getenv(cls.env) is not None:
+            return cls(os.getenv(cls.env), LLOOM_TOP_K)
+        return None
+
+# name -> Backend subclass, in the order they are tried when nothing is chosen explicitly
+BACKENDS = {}
+
+def register_backend(cls):
+    BACKENDS[cls.name] = cls
+    return cls
+
+@register_backend
+class LlamaBackend(Backend):
+    name = 'llama'
+    env = 'LLAMA_API_URL'
+    max_top_k = 100
+    supports_batching = True
+    supports_token_ids = True
+    supports_continuation = True
+    # set from the first response, continuations are only asked of servers known to report probabilities
+    # before sampling, which makes them the same as a sampled request's and fine to cache under its key
+    pre_sampling = None
+
+    def payload(self, prompt, n_predict=1):
+        # continuations are greedy
+        return { 'prompt': prompt,
+                'cache_prompt': True,
+                'temperature': 1.0 if n_predict == 1 else 0.0,
+                'n_predict': n_predict,
+                'top_k': self.top_k,
+                'top_p': 1.0,
+                'n_probs': self.top_k
+               }
+
+    def sampling_params(self):
+        return self.payload(None)
+
+    def fetch_model_name(self):
+        models = get_http_session().get(self.base_url+'/v1/models', timeout=REQUEST_TIMEOUT).json()
+        return models['data'][0]['id']
+
+    def post_json(self, payload, default):
+        response = post_retrying(self.base_url+'/completion', payload)
+        try:
+            response_json = response.json()
+        except json.JSONDecodeError:
+            print("Error: Failed to decode JSON from the response.")
+            return default
+        report_server_timings(llama_server_ms(response_json))
+        self.note_format(response_json)
+        return response_json
+
+    def note_format(self, response_json):
+        pre_sampling = llama_pre_sampling(response_json)
+        if pre_sampling is not None:
+            self.pre_sampling = pre_sampling
+
+    def get_logprobs(self, prompt):
+        return parse_llama_probs(self.post_json(self.payload(prompt), {}))
+
+    def get_logprobs_batch(self, prompts):
+        return parse_llama_batch(self.post_json(self.payload(prompts), []), len(prompts))
+
+    def get_continuation_batch(self, prompts, length):
+        if not self.pre_sampling:
+            return super().get_continuation_batch(prompts, length)
+        return parse_llama_batch(self.post_json(self.payload(prompts if len(prompts) > 1 else prompts[0], length), []), len(prompts), parse_llama_positions)
+
+    def tokenize(self, text):
+        # including the BOS token a text prompt would get
+        payload = { 'content': text, 'add_special': True }
+        response = get_http_session().post(self.base_url+'/tokenize', json=payload, timeout=REQUEST_TIMEOUT)
+        return response.json()['tokens']
+
+    async def async_post_json(self, session, payload, default):
+        async with await async_post_retrying(session, self.base_url+'/completion', payload) as response:
+            try:
+                response_json = await response.json(content_type=None)
+            except json.JSONDecodeError:
+                print("Error: Failed to decode JSON from the response.")
+                return default
+        report_server_timings(llama_server_ms(response_json))
+        self.note_format(response_json)
+        return response_json
+
+    async def async_get_logprobs(self, session, prompt):
+        return parse_llama_probs(await self.async_post_json(session, self.payload(prompt), {}))
+
+    async def async_get_logprobs_batch(self, session, prompts):
+        return parse_llama_batch(await self.async_post_json(session, self.payload(prompts), []), len(prompts))
+
+    async def async_get_continuation_batch(self, session, prompts, length):
+        if not self.pre_sampling:
+            return await super().async_get_continuation_batch(session, prompts, length)
+        return parse_llama_batch(await self.async_post_json(session, self.payload(prompts if len(prompts) > 1 else prompts[0], length), []), len(prompts), parse_llama_positions)
+
+## doh! no log probs from Kobold!
+@register_backend
+class KoboldBackend(Backend):
+    name = 'kobold'
+    env = 'KOBOLD_API_URL'
+
+    payload = LlamaBackend.payload
+    sampling_params = LlamaBackend.sampling_params
+    fetch_model_name = LlamaBackend.fetch_model_name
+
+    def get_logprobs(self, prompt):
+        response = post_retrying(self.base_url+'/v1/completions', self.payload(prompt))
+        probs = response.json()['completion_probabilities'][0]['probs']
+        return [ SimpleProbability(prob['tok_str'], prob['prob']) for prob in probs]
+
+    async def async_get_logprobs(self, session, prompt):
+        async with await async_post_retrying(session, self.base_url+'/v1/completions', self.payload(prompt)) as response:
+            response_json = await response.json(content_type=None)
+        probs = response_json['completion_probabilities'][0]['probs']
+        return [ SimpleProbability(prob['tok_str'], prob['prob']) for prob in probs]
+
+@register_backend
+class VllmBackend(Backend):
+    name = 'vllm'
+    env = 'VLLM_API_URL'
+    # vLLM's default --max-logprobs
+    max_top_k = 20
+    default_top_k = 5
+    supports_batching = True
+    supports_token_ids = True
+
+    def __init__(self, base_url=None, top_k=None):
+        super().__init__(base_url, top_k)
+        # token id -> text, vLLM only reports ids when it is sent a token id prompt
+        self.token_texts = {}
+
+    def payload(self, prompt, model):
+        return {
+            "prompt": prompt,
+            "n": 1,
+            "temperature": 0.0,
+            "max_tokens": 1,
+            "stream": False,
+            "logprobs": self.top_k,
+            "model": model,
+            # token id prompts need token ids back to extend them with
+            "return_tokens_as_token_ids": is_token_prompt(prompt)
+        }
+
+    def sampling_params(self):
+        return self.payload(None, None)
+
+    def fetch_model_name(self):
+        models = get_http_session().get(self.base_url+'/v1/models', timeout=REQUEST_TIMEOUT).json()
+        print('VLLM model name:', models['data'][0]['id'])
+        return models['data'][0]['id']
+
+    def resolve_tokens(self, logprobs):
+        for logprob in logprobs:
+            if logprob.token is None:
+                if logprob.token_id not in self.token_texts:
+                    payload = { 'model': self.model_name(), 'tokens': [logprob.token_id] }
+                    response = get_http_session().post(self.base_url+'/detokenize', json=payload, timeout=REQUEST_TIMEOUT)
+                    self.token_texts[logprob.token_id] = response.json()['prompt']
+                logprob.token = self.token_texts[logprob.token_id]
+        return logprobs
+
+    def get_logprobs(self, prompt):
+        return self.get_logprobs_batch([prompt])[0]
+
+    def get_logprobs_batch(self, prompts):
+        # a single prompt is sent on its own rather than as a batch of one
+        payload = self.payload(prompts if len(prompts) > 1 else prompts[0], self.model_name())
+        response = post_retrying(self.base_url+'/v1/completions', payload)
+        response_json = response.json()
+        return [ self.resolve_tokens(parse_vllm_probs(response_json, index)) for index in range(len(prompts)) ]
+
+    def tokenize(self, text):
+        payload = { 'model': self.model_name(), 'prompt': text, 'add_special_tokens': True }
+        response = get_http_session().post(self.base_url+'/tokenize', json=payload, timeout=REQUEST_TIMEOUT)
+        return response.json()['tokens']
+
+    async def async_resolve_tokens(self, session, logprobs):
+        for logprob in logprobs:
+            if logprob.token is None:
+                if logprob.token_id not in self.token_texts:
+                    payload = { 'model': self.model, 'tokens': [logprob.token_id] }
+                    async with session.post(self.base_url+'/detokenize', json=payload) as response:
+                        self.token_texts[logprob.token_id] = (await response.json(content_type=None))['prompt']
+                logprob.token = self.token_texts[logprob.token_id]
+        return logprobs
+
+    async def async_get_logprobs(self, session, prompt):
+        return (await self.async_get_logprobs_batch(session, [prompt]))[0]
+
+    async def async_get_logprobs_batch(self, session, prompts):
+        if self.model is None:
+            async with session.get(self.base_url+'/v1/models') as response:
+                models = await response.json(content_type=None)
+            self.model = models['data'][0]['id']
+            print('VLLM model name:', self.model)
+
+        payload = self.payload(prompts if len(prompts) > 1 else prompts[0], self.model)
+        async with await async_post_retrying(session, self.base_url+'/v1/completions', payload) as response:
+            response_json = await response.json(content_type=None)
+
+        return [ await self.async_resolve_tokens(session, parse_vllm_probs(response_json, index)) for index in range(len(prompts)) ]
+
+@register_backend
+class OpenAIBackend(Backend):
+    name = 'openai'
+    env = 'OPENAI_API_KEY'
+    max_top_k = 20
+
+    @classmethod
+    def from_env(cls):
+        # the key itself stays with the OpenAI client
+        if os.getenv(cls.env) is not None:
+            return cls(None, LLOOM_TOP_K)
+        return None
+
+    def open(self, pool_size):
+        get_openai_client(pool_size)
+
+    def fetch_model_name(self):
+        return "gpt-3.5-turbo"
+
+    def sampling_params(self):
+        return { 'temperature': 0.7, 'top_logprobs': self.top_k }
+
+    def request(self, prompt):
+        return dict(
+            model=self.model_name(),
+            messages=[{'role': 'user', 'content': prompt}],
+            temperature=0.7,
+            max_tokens=1,
+            logprobs=True,
+            top_logprobs=self.top_k,
+            n=1
+        )
+
+    def parse(self, response):
+        top_logprobs = response.choices[0].logprobs.content[0].top_logprobs
+        for logprob in top_logprobs:
+            logprob.probability = math.exp(logprob.logprob)
+        return top_logprobs
+
+    def get_logprobs(self, prompt):
+        return self.parse(get_openai_client().chat.completions.create(**self.request(prompt)))
+
+    def async_session(self, concurrency):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(timeout=REQUEST_TIMEOUT[1], max_retries=LLOOM_RETRIES)
+
+    async def async_get_logprobs(self, session, prompt):
+        return self.parse(await session.chat.completions.create(**self.request(prompt)))
+
+# Synthetic next-token distributions for benchmarking the search without a server: seeded per prompt
+# so runs are reproducible, with a per-request latency, random jitter and a fixed number of server slots.
+LLOOM_MOCK_SEED = int(os.getenv('LLOOM_MOCK_SEED', 0))
+LLOOM_MOCK_LATENCY = float(os.getenv('LLOOM_MOCK_LATENCY', 20))
+LLOOM_MOCK_JITTER = float(os.getenv('LLOOM_MOCK_JITTER', 5))
+LLOOM_MOCK_PER_PROMPT = float(os.getenv('LLOOM_MOCK_PER_PROMPT', 2))
+LLOOM_MOCK_PER_TOKEN = float(os.getenv('LLOOM_MOCK_PER_TOKEN', 5))
+LLOOM_MOCK_SLOTS = int(os.getenv('LLOOM_MOCK_SLOTS', 4))
+# dirichlet concentration, lower means peakier distributions and narrower trees
+LLOOM_MOCK_ALPHA = float(os.getenv('LLOOM_MOCK_ALPHA', 0.3))
+
+MOCK_VOCAB = [' the', ' a', ' and', ' of', ' to', ' in', ' was', ' he', ' she', ' it', ' that', ' his', ' her',
+              ' with', ' for', ' on', ' as', ' had', ' at', ' but', ' they', ' old', ' little', ' time', ' day',
+              ' night', ' house', ' forest', ' king', ' girl', ' man', ' dog', ' said', ' looked', ' went',
+              ' came', ' there', ' once', ' upon', ' lived', '.', ',', '!', ' "', '\n']
+
+@register_backend
+class MockBackend(Backend):
+    # only chosen with LLOOM_BACKEND=mock, it needs no server
+    name = 'mock'
+    max_top_k = len(MOCK_VOCAB)
+    supports_batching = True
+    supports_token_ids = True
+    supports_continuation = True
+
+    def __init__(self, base_url=None, top_k=None):
+        super().__init__(base_url, top_k)
+        self.seed = LLOOM_MOCK_SEED
+        self.latency = LLOOM_MOCK_LATENCY / 1000
+        self.jitter = LLOOM_MOCK_JITTER / 1000
+        self.per_prompt = LLOOM_MOCK_PER_PROMPT / 1000
+        self.per_token = LLOOM_MOCK_PER_TOKEN / 1000
+        self.slots = threading.Semaphore(LLOOM_MOCK_SLOTS)
+
+    @classmethod
+    def from_env(cls):
+        return cls(None, LLOOM_TOP_K)
+
+    def fetch_model_name(self):
+        return 'mock'
+
+    def sampling_params(self):
+        return { 'seed': self.seed, 'alpha': LLOOM_MOCK_ALPHA, 'top_k': self.top_k }
+
+    def distribution(self, prompt):
+        import zlib
+        import numpy as np
+
+        # token id prompts are decoded first so both kinds of prompt see the same distribution
+        text = self.detokenize(prompt) if is_token_prompt(prompt) else prompt
+        rng = np.random.default_rng([self.seed, zlib.crc32(text.encode('utf-8'))])
+        probs = rng.dirichlet([LLOOM_MOCK_ALPHA] * len(MOCK_VOCAB))
+        top = np.argsort(-probs)[:self.top_k]
+        return [ SimpleProbability(MOCK_VOCAB[i], float(probs[i]), int(i)) for i in top ]
+
+    def continuation(self, prompt, length):
+        # greedy, each distribution is for the prompt plus the top tokens before it
+        positions = []
+        for _ in range(length):
+            logprobs = self.distribution(prompt)
+            positions.append(logprobs)
+            prompt = prompt + [logprobs[0].token_id] if is_token_prompt(prompt) else prompt + logprobs[0].token
+        return positions
+
+    def tokenize(self, text):
+        # every character of the story is its own id, above the vocabulary
+        return [ len(MOCK_VOCAB) + ord(c) for c in text ]
+
+    def detokenize(self, ids):
+        return ''.join(MOCK_VOCAB[i] if i < len(MOCK_VOCAB) else chr(i - len(MOCK_VOCAB)) for i in ids)
+
+    def delay(self, count, length=1):
+        # exponential jitter gives the long tail a real server has
+        delay = self.latency + self.per_prompt * (count - 1) + self.per_token * (length - 1)
+        if self.jitter > 0:
+            delay += random.expovariate(1 / self.jitter)
+        return delay
+
+    def get_logprobs(self, prompt):
+        return self.get_logprobs_batch([prompt])[0]
+
+    def get_logprobs_batch(self, prompts):
+        return [ positions[0] for positions in self.get_continuation_batch(prompts, 1) ]
+
+    def get_continuation_batch(self, prompts, length):
+        with self.slots:
+            delay = self.delay(len(prompts), length)
+            time.sleep(delay)
+        # time spent "on the server", waiting for a slot isn't part of it
+        report_server_timings(delay * 1000)
+        return [ self.continuation(prompt, length) for prompt in prompts ]
+
+    def async_session(self, concurrency):
+        return MockSession()
+
+    async def async_get_logprobs(self, session, prompt):
+        return (await self.async_get_logprobs_batch(session, [prompt]))[0]
+
+    async def async_get_logprobs_batch(self, session, prompts):
+        return [ positions[0] for positions in await self.async_get_continuation_batch(session, prompts, 1) ]
+
+    async def async_get_continuation_batch(self, session, prompts, length):
+        import asyncio
+
+        async with session.slots:
+            delay = self.delay(len(prompts), length)
+            await asyncio.sleep(delay)
+        report_server_timings(delay * 1000)
+        return [ self.continuation(prompt, length) for prompt in prompts ]
+
+class MockSession:
+    # stands in for the aiohttp session, the server slots have to belong to the running event loop
+    async def __aenter__(self):
+        import asyncio
+        self.slots = asyncio.Semaphore(LLOOM_MOCK_SLOTS)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+backend_instances = {}
+backend_lock = threading.Lock()
+
+def resolve_backend(name=None):
+    # LLOOM_BACKEND (or name) picks a registered backend, otherwise the first one whose environment
+    # variable is set. Instances are kept so model lookups happen once per backend.
+    name = name or os.getenv('LLOOM_BACKEND')
+    candidates = [BACKENDS[name]] if name else [ cls for cls in BACKENDS.values() if cls.env is not None ]
+    key = (name,) + tuple(os.getenv(cls.env) for cls in candidates if cls.env is not None)
+
+    with backend_lock:
+        if key not in backend_instances:
+            backend = None
+            for cls in candidates:
+                backend = cls.from_env()
+                if backend is not None:
+                    break
+            if backend is None:
+                raise Exception('Please set either OPENAI_API_KEY or LLAMA_API_URL')
+            backend_instances[key] = backend
+        return backend_instances[key]
+
+def get_model_name():
+    try:
+        backend = resolve_backend()
+    except Exception:
+        return ""
+    return backend.display_name()
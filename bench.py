@@ -0,0 +1,101 @@
+import os
+import time
+import json
+
+# runs against the offline mock backend unless told otherwise, with no cache so every run does the same work
+os.environ.setdefault('LLOOM_BACKEND', 'mock')
+os.environ.setdefault('LLOOM_CACHE_MB', '0')
+
+from search import lloom_search
+from backends import resolve_backend
+from search_stats import SearchStats
+
+PROMPT = "Once upon a time,"
+
+# (max_depth, max_beams, stop_tokens, cutoff, multiplier, maxsplits)
+TREE_SHAPES = {
+    'narrow': (6, 50, [], 0.05, 1.0, 2),
+    'wide': (4, 200, [], 0.05, 1.0, 5),
+    'deep': (12, 50, [], 0.1, 1.0, 2),
+    'story': (6, 50, ['.', ','], 0.1, 1.0, 3),
+}
+
+BENCH_PARALLELISM = [ int(p) for p in os.getenv('BENCH_PARALLELISM', '1,2,4,8,16').split(',') ]
+BENCH_SHAPES = os.getenv('BENCH_SHAPES', ','.join(TREE_SHAPES)).split(',')
+BENCH_MODE = os.getenv('BENCH_MODE', 'breadth')
+BENCH_REPEATS = int(os.getenv('BENCH_REPEATS', 3))
+BENCH_OUTPUT = os.getenv('BENCH_OUTPUT')
+# Set BENCH_IMPORTS=1 to time how long each of BENCH_MODULES takes to import in a fresh interpreter instead,
+# which is what a CLI run or a worker pays before its first request
+BENCH_IMPORTS = os.getenv('BENCH_IMPORTS') is not None
+BENCH_MODULES = os.getenv('BENCH_MODULES', 'search,loom_server,loom_batch,loom_runall,lloom').split(',')
+HEAVY_MODULES = ['numpy', 'pandas', 'pyarrow', 'graphviz', 'requests', 'aiohttp', 'openai', 'streamlit']
+
+def run_once(shape, parallelism):
+    stats = SearchStats()
+    t0 = time.time()
+    first_beam = None
+    beams = 0
+    for beam in lloom_search(PROMPT, *TREE_SHAPES[shape], parallelism, mode=BENCH_MODE, stats=stats):
+        if first_beam is None:
+            first_beam = time.time() - t0
+        beams += 1
+
+    summary = stats.summary()
+    return dict(summary,
+        shape=shape,
+        parallelism=parallelism,
+        first_beam=first_beam or 0.0,
+        beams_per_request=beams / summary['requests'] if summary['requests'] else 0.0,
+    )
+
+def median_run(shape, parallelism):
+    # the repeat with the median wall time, so one slow run doesn't skew the table
+    runs = sorted((run_once(shape, parallelism) for _ in range(BENCH_REPEATS)), key=lambda run: run['seconds'])
+    return runs[len(runs) // 2]
+
+def import_once(module):
+    import sys
+    import subprocess
+
+    # the import alone, then the optional dependencies it dragged in, as the last two lines of output
+    code = f"import sys, time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t); print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    t0 = time.time()
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+    return dict(module=module, import_ms=float(output[-2]) * 1000, process_ms=(time.time() - t0) * 1000, loaded=output[-1])
+
+def bench_imports():
+    print(f"{'module':>12} {'import':>8} {'process':>8}  loaded")
+    results = []
+    for module in BENCH_MODULES:
+        runs = sorted((import_once(module) for _ in range(BENCH_REPEATS)), key=lambda run: run['process_ms'])
+        r = runs[len(runs) // 2]
+        results.append(r)
+        print(f"{r['module']:>12} {r['import_ms']:>6.0f}ms {r['process_ms']:>6.0f}ms  {r['loaded']}")
+    return results
+
+def main():
+    if BENCH_IMPORTS:
+        results = bench_imports()
+        if BENCH_OUTPUT:
+            with open(BENCH_OUTPUT, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    print(f"backend: {resolve_backend().name}  mode: {BENCH_MODE}  async: {os.getenv('LLOOM_ASYNC') is not None}  repeats: {BENCH_REPEATS}")
+    print(f"{'shape':>8} {'par':>4} {'secs':>7} {'first':>6} {'beams':>6} {'reqs':>5} {'req/s':>8} {'tok/s':>8} {'queue':>7} {'p50ms':>7} {'p95ms':>7} {'p99ms':>7} {'busy':>5} {'beams/req':>9}")
+
+    results = []
+    for shape in BENCH_SHAPES:
+        for parallelism in BENCH_PARALLELISM:
+            r = median_run(shape, parallelism)
+            results.append(r)
+            print(f"{r['shape']:>8} {r['parallelism']:>4} {r['seconds']:>7.2f} {r['first_beam']:>6.2f} {r['beams']:>6} {r['requests']:>5} {r['requests_per_sec']:>8.1f} {r['tokens_per_sec']:>8.1f} {r['queue_ms_mean']:>7.1f} {r['network_ms_p50']:>7.1f} {r['network_ms_p95']:>7.1f} {r['network_ms_p99']:>7.1f} {r['occupancy_mean']:>5.1f} {r['beams_per_request']:>9.2f}")
+
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {BENCH_OUTPUT}")
+
+if __name__ == "__main__":
+    main()
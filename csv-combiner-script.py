@@ -1,63 +1,57 @@
 import os
 import pandas as pd
-from collections import defaultdict
-import re
 
-def clean_thread_column(text):
+from result_store import LLOOM_RESULTS_PATH, read_results
+
+def clean_thread_column(threads):
+    threads = threads.astype(str)
     # Remove non-ASCII characters
-    text = re.sub(r'[^\x00-\x7F]+', '', text)
+    threads = threads.str.replace(r'[^\x00-\x7F]+', '', regex=True)
     # Remove newlines
-    text = text.replace('\n', ' ').replace('\r', '')
+    threads = threads.str.replace('\n', ' ', regex=False).str.replace('\r', '', regex=False)
     # Remove quotes
-    text = text.replace('"', '')
-    #.replace("'", "")
+    threads = threads.str.replace('"', '', regex=False)
     # Replace multiple spaces with a single space
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    threads = threads.str.replace(r'\s+', ' ', regex=True)
+    return threads.str.strip()
+
+def load_csv_files(folder_path, story_keys):
+    # one long frame of every file's rows, labelled with the file they came from
+    frames = []
+    for file in sorted(f for f in os.listdir(folder_path) if f.endswith('.csv')):
+        df = pd.read_csv(os.path.join(folder_path, file))
+        df = df[df['Story_Key'].isin(story_keys)]
+        frames.append(df.assign(Source=os.path.splitext(file)[0]))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Story_Key', 'Probability', 'Thread', 'Source'])
+
+def load_results(results_path, story_keys):
+    # the same rows straight from the Parquet dataset, only the partitions and columns needed are read
+    df = read_results(results_path, story_keys=story_keys, columns=['model', 'story', 'rank', 'probability', 'thread'])
+    df = df.sort_values(['model', 'story', 'rank'])
+    return pd.DataFrame({ 'Story_Key': df['story'], 'Probability': df['probability'], 'Thread': df['thread'], 'Source': df['model'] })
+
+def combine_csv_files(folder_path, story_keys, results_path=None):
+    df = load_results(results_path, story_keys) if results_path else load_csv_files(folder_path, story_keys)
+    df['Thread'] = clean_thread_column(df['Thread'])
+    # row n of the combined file holds every source's n-th suggestion side by side
+    df['Row'] = df.groupby(['Story_Key', 'Source'], sort=False).cumcount()
+    sources = list(dict.fromkeys(df['Source']))
 
-def combine_csv_files(folder_path, story_keys):
-    combined_data = {key: defaultdict(list) for key in story_keys}
-    max_entries = {key: 0 for key in story_keys}
-    
-    csv_files = [f for f in os.listdir(folder_path) if f.endswith('.csv')]
-    
-    for file in csv_files:
-        file_path = os.path.join(folder_path, file)
-        df = pd.read_csv(file_path)
-        
-        # Clean the 'Thread' column
-        if 'Thread' in df.columns:
-            df['Thread'] = df['Thread'].astype(str).apply(clean_thread_column)
-        
-        file_prefix = os.path.splitext(file)[0]
-        df_filtered = df[df['Story_Key'].isin(story_keys)]
-        
-        for key in story_keys:
-            key_data = df_filtered[df_filtered['Story_Key'] == key]
-            num_entries = len(key_data)
-            max_entries[key] = max(max_entries[key], num_entries)
-            
-            for col in df.columns:
-                if col != 'Story_Key':
-                    combined_data[key][f'{file_prefix} {col}'].extend(key_data[col].tolist())
-    
-    # Pad shorter lists with None values
-    for key in story_keys:
-        for col in combined_data[key]:
-            current_length = len(combined_data[key][col])
-            if current_length < max_entries[key]:
-                combined_data[key][col].extend([None] * (max_entries[key] - current_length))
-    
-    # Create and save combined DataFrames for each Story_Key
     for key in story_keys:
-        if combined_data[key]:
-            result_df = pd.DataFrame(combined_data[key])
-            result_df.insert(0, 'Story_Key', [key] * len(result_df))
-            output_file = f'{key}_combined.csv'
-            result_df.to_csv(output_file, index=False, quoting=1)  # quoting=1 to quote all fields
-            print(f"Combined data for '{key}' saved as '{output_file}'")
-        else:
+        key_data = df[df['Story_Key'] == key]
+        if key_data.empty:
             print(f"No data found for Story_Key: '{key}'")
+            continue
+        result_df = key_data.pivot(index='Row', columns='Source', values=['Probability', 'Thread'])
+        # Source-major column order as before: '<source> Probability', '<source> Thread', ...
+        # every source gets its columns, left empty where it had nothing for this story
+        columns = [ (col, source) for source in sources for col in ['Probability', 'Thread'] ]
+        result_df = result_df.reindex(columns=pd.MultiIndex.from_tuples(columns))
+        result_df.columns = [ f'{source} {col}' for col, source in columns ]
+        result_df.insert(0, 'Story_Key', key)
+        output_file = f'{key}_combined.csv'
+        result_df.to_csv(output_file, index=False, quoting=1)  # quoting=1 to quote all fields
+        print(f"Combined data for '{key}' saved as '{output_file}'")
 
 # Specify the folder path containing your CSV files
 folder_path = 'csv'
@@ -65,5 +59,5 @@ folder_path = 'csv'
 # List of Story_Keys to filter
 story_keys = ["alice_and_james", "it_was_after", "his_body_was", "once_upon_a", "in_the_age"]
 
-# Run the function to combine CSV files
-combine_csv_files(folder_path, story_keys)
+# Run the function to combine CSV files, or the Parquet dataset when LLOOM_RESULTS_PATH is set
+combine_csv_files(folder_path, story_keys, LLOOM_RESULTS_PATH)
@@ -3,10 +3,13 @@ import hashlib
 import time
 import os
 import json
-import pandas as pd
+import functools
 
 from viz import visualize_common_prefixes
-from search import parallel_lloom_search, get_model_name
+from search import lloom_search, get_model_name
+from logprob_cache import get_logprob_cache
+from search_stats import SearchStats
+from token_tree import TokenTree
 
 STARTING_STORIES = [
     "Alice and James unexpectedly connect over a shared love for the Dusty Tome an old bookstore nestled on the edge of town. The scent of aging paper and leather bound Alice in a warm embrace as she browsed the labyrinthine aisles, it was her haven.",
@@ -19,13 +22,80 @@ STARTING_STORIES = [
 
 
 LLAMA_PIPELINE_REQUESTS = int(os.getenv('LLAMA_PIPELINE_REQUESTS', 1))
-print("LLAMA_PIPELINE_REQUESTS", LLAMA_PIPELINE_REQUESTS)
+
+# Seconds between redraws of the suggestions found so far while a search is running
+LLOOM_UI_REFRESH = float(os.getenv('LLOOM_UI_REFRESH', 0.5))
 
 def computeMD5hash(my_string):
     m = hashlib.md5()
     m.update(my_string.encode('utf-8'))
     return m.hexdigest()
 
+def accept_story(new_story):
+    # keep the explored subtree below the new story so the next search only has to extend its frontier
+    tree = st.session_state.tree
+    st.session_state.tree = tree.reroot(new_story) if tree is not None else None
+    st.session_state.story_so_far = new_story
+    st.session_state.threads = None
+
+def rank_threads(threads):
+    # threads are (probability, new text, depth), the story was cut off each one once as it arrived
+    sorted_threads = sorted(threads, key=lambda x: x[0], reverse=True)
+
+    # remove duplicate threads
+    dedupe = {}
+    good_threads = []
+    add_space = False
+    for prob, new_tokens, depth in sorted_threads:
+        if new_tokens[0] == ' ': 
+            new_tokens = new_tokens[1:]
+            add_space = True
+        if dedupe.get(new_tokens) is None:
+            dedupe[new_tokens] = prob
+            good_threads.append( (prob, new_tokens) )
+
+    return sorted_threads, good_threads, add_space
+
+def keep_threads(threads):
+    sorted_threads, good_threads, add_space = rank_threads(threads)
+    st.session_state.threads = good_threads
+    st.session_state.sorted_threads = sorted_threads
+    st.session_state.add_space = add_space
+    return good_threads, add_space
+
+def stop_search():
+    # runs before the interrupted search's rerun: show what it had found instead of searching again
+    keep_threads(st.session_state.partial_threads)
+
+def render_progress(graph, suggestions, threads, story_so_far, refresh):
+    # widget keys must be unique within a script run, so every redraw gets its own
+    sorted_threads, good_threads, add_space = rank_threads(threads)
+    graph.graphviz_chart(visualize_common_prefixes([ thread for prob, thread in good_threads ], [ prob for prob, thread in good_threads ]))
+    sum_probs = sum([prob for prob, _ in good_threads])
+    with suggestions.container():
+        st.button('Stop searching', key=f'stop-{refresh}', on_click=stop_search)
+        for prob, thread in good_threads:
+            col1, col2 = st.columns((3,1))
+            col2.progress(value=prob/sum_probs)
+            col1.text(thread)
+            col2.button(':arrow_right:', key=f'early-{refresh}-'+computeMD5hash(thread), on_click=accept_story, args=(story_so_far + (" " if add_space else "") + thread,))
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_exports(threads):
+    # reruns with the same suggestions (checkbox toggles, downloads) reuse the graph and files
+    import pandas as pd
+
+    dataframe = pd.DataFrame(threads, columns=['Probability', 'Thread'])
+    viz = visualize_common_prefixes([ thread for prob, thread in threads ], [ prob for prob, thread in threads ])
+    return viz.source, json.dumps(threads), dataframe.to_csv(index=False)
+
+@functools.lru_cache(maxsize=8)
+def render_png(dot_source):
+    # only runs when the PNG is downloaded, off the script thread, so no st.cache_data here
+    import graphviz
+
+    return graphviz.Source(dot_source).pipe(format='png')
+
 def main():
 
     st.set_page_config(layout='wide', page_title='The LLooM')
@@ -46,6 +116,7 @@ def main():
     if 'page' not in st.session_state:
         st.session_state.page = 0
         st.session_state.threads = None
+        st.session_state.tree = None
         
     logo, config = st.columns((1,5))
     logo.markdown("### The LLooM :green[v0.3]")
@@ -56,6 +127,9 @@ def main():
         story_depth = config_cols[0].checkbox("Auto-Stop (early terminate if a period or comma is encountered)", value=False)
         depth = config_cols[0].number_input("Maximum Depth", min_value=1, max_value=50, value=6, help="Terminate a sugguestion when it gets this long")
         maxsuggestions = config_cols[0].number_input("Beam Limit", min_value=5, max_value=100, value=100, help="Stop spawning new beams when the number of suggestions hits this limit")
+        search_mode = config_cols[0].selectbox("Search Mode", ['Breadth-first', 'Best-first'], help="Best-first always expands the most probable beam next and stops once the top Beam Limit suggestions are settled or the Request Budget is spent")
+        request_budget = config_cols[0].number_input("Request Budget", min_value=1, max_value=5000, value=200, help="Best-first only: the maximum number of requests to make to the backend")
+        time_limit = config_cols[0].number_input("Time Limit", min_value=0.0, max_value=600.0, value=0.0, step=1.0, help="Stop searching after this many seconds and show the best suggestions found so far (0: no limit)")
         
         config_cols[1].markdown('_Split conditions_\n\nLower the Cutoff to get more variety (at the expense of quality and speed), raise Cutoff for a smaller number of better suggestions.')
         cutoff = config_cols[1].number_input("Cutoff", help="Minimum propability of a token to have it split a new suggestion beam", min_value=0.0, max_value=1.0, value=0.1, step=0.01)
@@ -69,6 +143,7 @@ def main():
         start_prompt = st.selectbox("Start Prompt", STARTING_STORIES, index=0)
         if st.button("Start"):
             st.session_state.story_so_far = start_prompt
+            st.session_state.tree = None
             st.session_state.page = 1
             st.rerun()
     else:
@@ -76,72 +151,74 @@ def main():
         new_story_so_far = left.text_area("Story so far", story_so_far, label_visibility='hidden', height=300)
         if left.button('Suggest Again'):
             story_so_far = new_story_so_far
-            st.session_state.story_so_far = story_so_far
-            st.session_state.threads = None
+            accept_story(story_so_far)
         
         if st.session_state.threads == None:
             please_wait = st.empty()
-            t0 = time.time()
-            tokens = 0
+            live_graph = right.empty()
+            live_suggestions = st.empty()
+            stats = SearchStats()
             
             with please_wait.status('Searching for suggestions, please wait..') as status:
                 threads = []
-                for thread in parallel_lloom_search(story_so_far, depth, maxsuggestions, ['.',','] if story_depth else [], cutoff, multiplier, maxsplits, LLAMA_PIPELINE_REQUESTS):
-                    label = thread[1][len(story_so_far):]
-                    status.update(label=label, state="running")
-                    threads.append(thread)
-                    tokens += thread[2]
-
-                delta = time.time() - t0
-                tps = tokens/delta
-                status.update(label=f"Search completed, found {len(threads)} suggestion in {delta:.2f}s @ {tps:.2f} tokens/sec", state="complete", expanded=False)
-            
-            sorted_threads = sorted(threads, key=lambda x: x[0], reverse=True)
-            
-            # remove duplicate threads
-            dedupe = {}
-            good_threads = []
-            add_space = False
-            for prob, thread, depth in sorted_threads:
-                new_tokens = thread[len(story_so_far):]
-                if new_tokens[0] == ' ': 
-                    new_tokens = new_tokens[1:]
-                    thread = story_so_far + " " + thread[len(story_so_far):]
-                    add_space = True
-                if dedupe.get(new_tokens) is None:
-                    dedupe[new_tokens] = prob
-                    good_threads.append( (prob, new_tokens) )
-
-            st.session_state.threads = good_threads
-            st.session_state.sorted_threads = sorted_threads
-            st.session_state.add_space = add_space
+                st.session_state.partial_threads = threads
+                tree = st.session_state.tree
+                if tree is None or tree.prompt != story_so_far:
+                    tree = TokenTree(story_so_far)
+                st.session_state.tree = tree
+                search_args = { 'mode': 'best', 'max_requests': request_budget } if search_mode == 'Best-first' else {}
+                search = lloom_search(story_so_far, depth, maxsuggestions, ['.',','] if story_depth else [], cutoff, multiplier, maxsplits, LLAMA_PIPELINE_REQUESTS, tree=tree, stats=stats, deadline=time_limit or None, **search_args)
+                last_refresh = time.time()
+                refreshes = 0
+                try:
+                    # clicking Stop or an early accept reruns the script, which interrupts this loop;
+                    # closing the search then cancels its queued requests
+                    for prob, thread, level in search:
+                        label = thread[len(story_so_far):]
+                        status.update(label=label, state="running")
+                        threads.append((prob, label, level))
+
+                        if time.time() - last_refresh > LLOOM_UI_REFRESH:
+                            refreshes += 1
+                            render_progress(live_graph, live_suggestions, threads, story_so_far, refreshes)
+                            last_refresh = time.time()
+                finally:
+                    search.close()
+
+                summary = stats.summary()
+                cache = get_logprob_cache()
+                cache_label = f", {cache.stats()['hits']} cache hits total" if cache is not None else ""
+                status.update(label=f"Search completed, found {len(threads)} suggestion in {summary['seconds']:.2f}s @ {summary['tokens_per_sec']:.2f} tokens/sec, {summary['requests']} requests{cache_label}", state="complete", expanded=False)
+
+            live_graph.empty()
+            live_suggestions.empty()
+            good_threads, add_space = keep_threads(threads)
             
             # if there is only one option - take it.
             if len(good_threads) == 1:
-                st.session_state.story_so_far += (" " if add_space else "") + good_threads[0][1]
-                st.session_state.threads = None
+                accept_story(story_so_far + (" " if add_space else "") + good_threads[0][1])
                 st.rerun()  
             
         threads = st.session_state.threads
         add_space = st.session_state.add_space
-        json_data = json.dumps(threads)
-        modelname = get_model_name()
-        dataframe = pd.DataFrame(threads, columns=['Probability', 'Thread'])
-        csv_data = dataframe.to_csv(index=False)
-        labels = [ thread for prob, thread in threads ]
+        if 'modelname' not in st.session_state:
+            # asking the server once per session is enough
+            st.session_state.modelname = get_model_name()
+        modelname = st.session_state.modelname
+        dot_source, json_data, csv_data = render_exports(threads)
 
 
         story_so_far_words = story_so_far.split()[:3]
         joined_words = "_".join(word.lower() for word in story_so_far_words)
         
-        viz = visualize_common_prefixes(labels)
         with right:
             
-            st.graphviz_chart(viz)
-            st.download_button('Download DOT Graph', viz.source, 'graph.dot', 'text/plain')
-            st.download_button('Download PNG', viz.pipe(format='png'), 'graph.png', 'image/png')
-            st.download_button('Download JSON', json_data, 'loom_data.'+modelname+'.'+joined_words+'.json', 'application/json')
-            st.download_button('Download CSV', csv_data, 'loom_data.'+modelname+'.'+joined_words+'.csv', 'text/csv')         
+            st.graphviz_chart(dot_source)
+            # downloads don't need a rerun, and the PNG is only drawn when asked for
+            st.download_button('Download DOT Graph', dot_source, 'graph.dot', 'text/plain', on_click='ignore')
+            st.download_button('Download PNG', lambda: render_png(dot_source), 'graph.png', 'image/png', on_click='ignore')
+            st.download_button('Download JSON', json_data, 'loom_data.'+modelname+'.'+joined_words+'.json', 'application/json', on_click='ignore')
+            st.download_button('Download CSV', csv_data, 'loom_data.'+modelname+'.'+joined_words+'.csv', 'text/csv', on_click='ignore')         
 
         controls = st.container()        
         buttons = st.container()
@@ -156,8 +233,7 @@ def main():
                 col2.progress(value=prob/sum_probs)
                 new_text = col1.text_input(thread, value=thread, key='text-'+computeMD5hash(thread), label_visibility='hidden')
                 if col2.button(':arrow_right:', key='ok-'+computeMD5hash(thread)):
-                    st.session_state.story_so_far += (" " if user_add_space else "") + new_text
-                    st.session_state.threads = None
+                    accept_story(st.session_state.story_so_far + (" " if user_add_space else "") + new_text)
                     st.rerun()                
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Memory budget for cached logprobs (0 disables the cache) and an optional SQLite file to persist them in
+LLOOM_CACHE_MB = float(os.getenv('LLOOM_CACHE_MB', 64))
+LLOOM_CACHE_PATH = os.getenv('LLOOM_CACHE_PATH')
+
+class LogprobCache:
+    def __init__(self, max_bytes, path=None):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS logprobs (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.commit()
+
+    @staticmethod
+    def make_key(backend, model, prompt, params):
+        # hashed so memory use doesn't depend on how long the story has grown
+        raw = json.dumps([backend, model, prompt, params], sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value FROM logprobs WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    value = json.loads(row[0])
+                    self._remember(key, value, len(row[0]))
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # value is a list of (token, probability, token_id) triples, token_id None when the backend gave none.
+        # Entries written before token ids were kept are pairs, which read back the same way.
+        encoded = json.dumps(value)
+        with self.lock:
+            self._remember(key, value, len(encoded))
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO logprobs (key, value) VALUES (?, ?)', (key, encoded))
+                self.db.commit()
+
+    def _remember(self, key, value, encoded_size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+        # rough in-memory footprint: key, list/tuple overhead and the encoded tokens
+        entry_size = len(key) + 100 + 2 * encoded_size
+        self.entries[key] = (value, entry_size)
+        self.size += entry_size
+
+        while self.size > self.max_bytes and self.entries:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.size
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+logprob_cache = None
+logprob_cache_lock = threading.Lock()
+
+def get_logprob_cache():
+    # process-wide cache, or None when LLOOM_CACHE_MB is 0
+    global logprob_cache
+    with logprob_cache_lock:
+        if logprob_cache is None and LLOOM_CACHE_MB > 0:
+            logprob_cache = LogprobCache(int(LLOOM_CACHE_MB * 1024 * 1024), LLOOM_CACHE_PATH)
+        return logprob_cache
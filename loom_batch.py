@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from search import LLOOM_ADAPTIVE, parallel_lloom_search, adaptive_limiter
+from backends import BACKENDS, LLOOM_TOP_K, resolve_backend
+from loom_runall import STARTING_STORIES, LLAMA_PIPELINE_REQUESTS, computeMD5hash, story_key, process_story, store_story, save_results
+
+# Every story is searched at once against every model served from LLOOM_RUN_URLS (comma separated,
+# defaults to the usual backend environment variables). Each server gets LLOOM_RUN_CONCURRENCY requests
+# in flight shared by all the stories on it, and finished stories are appended to LLOOM_RUN_CHECKPOINT
+# as they complete so a restarted sweep skips them.
+LLOOM_RUN_URLS = os.getenv('LLOOM_RUN_URLS')
+LLOOM_RUN_CONCURRENCY = int(os.getenv('LLOOM_RUN_CONCURRENCY', LLAMA_PIPELINE_REQUESTS))
+LLOOM_RUN_CHECKPOINT = os.getenv('LLOOM_RUN_CHECKPOINT', 'loom_runall.checkpoint.jsonl')
+
+def run_backends():
+    if LLOOM_RUN_URLS is None:
+        return [ resolve_backend() ]
+    cls = BACKENDS[os.getenv('LLOOM_BACKEND', 'llama')]
+    return [ cls(url.strip(), LLOOM_TOP_K) for url in LLOOM_RUN_URLS.split(',') ]
+
+def load_checkpoint(path):
+    # model -> story hash -> (story key, threads) for every story a previous run finished
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the line a crash cut short
+                    continue
+                done.setdefault(entry['model'], {})[entry['story']] = (entry['key'], [ tuple(thread) for thread in entry['threads'] ])
+    return done
+
+def main():
+    backends = run_backends()
+    done = load_checkpoint(LLOOM_RUN_CHECKPOINT)
+    checkpoint = open(LLOOM_RUN_CHECKPOINT, 'a+')
+    if checkpoint.tell() > 0:
+        checkpoint.seek(checkpoint.tell() - 1)
+        if checkpoint.read(1) != '\n':
+            # start on a fresh line after the half written one a crash left behind
+            checkpoint.write('\n')
+    checkpoint_lock = threading.Lock()
+
+    # servers running the same model are replicas and split its stories between them
+    replicas = {}
+    for backend in backends:
+        # every story on this server shares its request slots, with LLOOM_ADAPTIVE the server's load sizes them
+        backend.open(LLOOM_RUN_CONCURRENCY)
+        limiter = adaptive_limiter(backend, LLOOM_RUN_CONCURRENCY) if LLOOM_ADAPTIVE else threading.Semaphore(LLOOM_RUN_CONCURRENCY)
+        replicas.setdefault(backend.display_name(), []).append((backend, limiter))
+
+    jobs = []
+    for modelname, servers in replicas.items():
+        pending = []
+        for story in STARTING_STORIES:
+            if computeMD5hash(story) in done.get(modelname, {}):
+                print(f"Skipping story already in checkpoint: {modelname} {story[:50]}...")
+                continue
+            pending.append(story)
+        for i, story in enumerate(pending):
+            backend, limiter = servers[i % len(servers)]
+            jobs.append((backend, modelname, limiter, story))
+
+    def run(backend, modelname, limiter, story):
+        threads, summary = process_story(story, search=parallel_lloom_search, parallelism=LLOOM_RUN_CONCURRENCY, backend=backend, limiter=limiter)
+        store_story(modelname, story, threads, summary)
+        with checkpoint_lock:
+            checkpoint.write(json.dumps({ 'model': modelname, 'story': computeMD5hash(story), 'key': story_key(story), 'threads': threads }) + '\n')
+            checkpoint.flush()
+            done.setdefault(modelname, {})[computeMD5hash(story)] = (story_key(story), threads)
+        return modelname
+
+    print(f"Searching {len(jobs)} stories for {len(replicas)} models on {len(backends)} servers, {LLOOM_RUN_CONCURRENCY} requests in flight per server")
+    try:
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+            for future in as_completed([ executor.submit(run, *job) for job in jobs ]):
+                future.result()
+    finally:
+        checkpoint.close()
+
+    # same CSV per model as loom_runall.py, from everything finished so far and before
+    for modelname, stories in done.items():
+        save_results(dict(stories.values()), modelname)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import hashlib
-import time
 import os
 import json
-import pandas as pd
-from search import parallel_lloom_search, get_model_name
+from search import lloom_search, get_model_name
+from logprob_cache import get_logprob_cache
+from search_stats import SearchStats
+from result_store import LLOOM_RESULTS_PATH, write_story_results
 
 STARTING_STORIES = [
     "Alice and James unexpectedly connect over a shared love for the Dusty Tome an old bookstore nestled on the edge of town. The scent of aging paper and leather bound Alice in a warm embrace as she browsed the labyrinthine aisles, it was her haven.",
@@ -15,59 +16,70 @@ STARTING_STORIES = [
 ]
 
 LLAMA_PIPELINE_REQUESTS = int(os.getenv('LLAMA_PIPELINE_REQUESTS', 1))
-print("LLAMA_PIPELINE_REQUESTS", LLAMA_PIPELINE_REQUESTS)
 
 def computeMD5hash(my_string):
     m = hashlib.md5()
     m.update(my_string.encode('utf-8'))
     return m.hexdigest()
 
-def process_story(story, depth=6, maxsuggestions=50, story_depth=False, cutoff=0.1, multiplier=1.0, maxsplits=3):
+def story_key(story):
+    story_so_far_words = story.split()[:3]
+    return "_".join(word.lower() for word in story_so_far_words)
+
+def process_story(story, depth=6, maxsuggestions=50, story_depth=False, cutoff=0.1, multiplier=1.0, maxsplits=3, search=lloom_search, parallelism=LLAMA_PIPELINE_REQUESTS, **search_args):
+    # returns the deduplicated (probability, text, depth) suggestions and the search's stats summary
     print(f"Processing story: {story[:50]}...")
-    t0 = time.time()
-    tokens = 0
+    stats = SearchStats()
     
     threads = []
-    for thread in parallel_lloom_search(story, depth, maxsuggestions, ['.',','] if story_depth else [], cutoff, multiplier, maxsplits, LLAMA_PIPELINE_REQUESTS):
-        label = thread[1][len(story):]
-        threads.append(thread)
-        tokens += thread[2]
+    for prob, thread, level in search(story, depth, maxsuggestions, ['.',','] if story_depth else [], cutoff, multiplier, maxsplits, parallelism, stats=stats, **search_args):
+        # only the new text is kept, not a copy of the story per suggestion
+        threads.append((prob, thread[len(story):], level))
 
-    delta = time.time() - t0
-    tps = tokens/delta
-    print(f"Search completed, found {len(threads)} suggestions in {delta:.2f}s @ {tps:.2f} tokens/sec")
+    summary = stats.summary()
+    print(f"Search completed, found {len(threads)} suggestions in {summary['seconds']:.2f}s @ {summary['tokens_per_sec']:.2f} tokens/sec")
+    print(f"{summary['requests']} requests @ {summary['requests_per_sec']:.2f}/sec, queue {summary['queue_ms_mean']:.1f}ms, network p50 {summary['network_ms_p50']:.1f}ms p95 {summary['network_ms_p95']:.1f}ms")
+    if get_logprob_cache() is not None:
+        print("Logprob cache:", get_logprob_cache().stats())
     
     sorted_threads = sorted(threads, key=lambda x: x[0], reverse=True)
     
     # remove duplicate threads
     dedupe = {}
     good_threads = []
-    for prob, thread, depth in sorted_threads:
-        new_tokens = thread[len(story):]
+    for prob, new_tokens, depth in sorted_threads:
         if new_tokens[0] == ' ':
             new_tokens = new_tokens[1:]
-            thread = story + " " + thread[len(story):]
         if dedupe.get(new_tokens) is None:
             dedupe[new_tokens] = prob
-            good_threads.append((prob, new_tokens))
+            good_threads.append((prob, new_tokens, depth))
     
-    return good_threads
+    return good_threads, summary
+
+def store_story(modelname, story, threads, summary):
+    # each story lands in the Parquet dataset as soon as it's done
+    if LLOOM_RESULTS_PATH:
+        write_story_results(LLOOM_RESULTS_PATH, modelname, story_key(story), story, threads, summary)
 
 def main():
+    print("LLAMA_PIPELINE_REQUESTS", LLAMA_PIPELINE_REQUESTS)
     all_results = {}
     modelname = get_model_name()
 
     for story in STARTING_STORIES:
-        story_so_far_words = story.split()[:3]
-        joined_words = "_".join(word.lower() for word in story_so_far_words)
-        
-        threads = process_story(story)
-        all_results[joined_words] = threads
+        threads, summary = process_story(story)
+        store_story(modelname, story, threads, summary)
+        all_results[story_key(story)] = threads
+
+    save_results(all_results, modelname)
+
+def save_results(all_results, modelname):
+    import pandas as pd
 
     # Prepare data for CSV
     csv_data = []
     for key, threads in all_results.items():
-        for prob, thread in threads:
+        for prob, thread, *_ in threads:
             csv_data.append({
                 'Story_Key': key,
                 'Probability': prob,
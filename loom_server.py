@@ -0,0 +1,208 @@
+import os
+import json
+import math
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from search import LLOOM_ADAPTIVE, parallel_lloom_search, adaptive_limiter, open_backend, request_slots, worker_count
+from backends import resolve_backend
+from logprob_cache import get_logprob_cache
+from search_stats import SearchStats
+
+# Serves the breadth-first search over HTTP on LLOOM_SERVE_HOST:LLOOM_SERVE_PORT, streaming beams back as
+# server-sent events. Every client shares one backend connection pool, the logprob cache, one worker pool
+# and LLOOM_SERVE_CONCURRENCY requests in flight (sized by the server's load with LLOOM_ADAPTIVE).
+LLOOM_SERVE_HOST = os.getenv('LLOOM_SERVE_HOST', '127.0.0.1')
+LLOOM_SERVE_PORT = int(os.getenv('LLOOM_SERVE_PORT', 8765))
+LLOOM_SERVE_CONCURRENCY = int(os.getenv('LLOOM_SERVE_CONCURRENCY', os.getenv('LLAMA_PIPELINE_REQUESTS', 4)))
+# the most one explore request may ask for, so a single client can't hold the backend indefinitely
+LLOOM_SERVE_MAX_DEPTH = int(os.getenv('LLOOM_SERVE_MAX_DEPTH', 50))
+LLOOM_SERVE_MAX_BEAMS = int(os.getenv('LLOOM_SERVE_MAX_BEAMS', 200))
+LLOOM_SERVE_DEADLINE = float(os.getenv('LLOOM_SERVE_DEADLINE', 120))
+# seconds between keep-alive comments on a stream with no new beams, this is also how long it takes to
+# notice a client that went away
+LLOOM_SERVE_HEARTBEAT = float(os.getenv('LLOOM_SERVE_HEARTBEAT', 5))
+
+# explore parameter -> (type, default), the names follow the search's arguments
+EXPLORE_PARAMS = {
+    'depth': (int, 6),
+    'max_beams': (int, 50),
+    'cutoff': (float, 0.1),
+    'multiplier': (float, 1.0),
+    'maxsplits': (int, 3),
+    'deadline': (float, None),
+    'max_requests': (int, None),
+}
+
+def explore_args(params):
+    # validated search arguments from a JSON body or query string, raises ValueError on bad input
+    prompt = params.get('prompt')
+    if not isinstance(prompt, str) or not prompt:
+        raise ValueError('prompt is required')
+
+    args = { 'prompt': prompt }
+    for name, (kind, default) in EXPLORE_PARAMS.items():
+        value = params.get(name, default)
+        try:
+            args[name] = kind(value) if value is not None else None
+        except (TypeError, ValueError, OverflowError):
+            # OverflowError is int() of an infinite float, JSON reads 1e400 as one
+            raise ValueError(f'{name} must be a number')
+        if isinstance(args[name], float) and not math.isfinite(args[name]):
+            raise ValueError(f'{name} must be a finite number')
+
+    stop_tokens = params.get('stop_tokens', [])
+    if isinstance(stop_tokens, str):
+        stop_tokens = [stop_tokens]
+    if not isinstance(stop_tokens, list) or not all(isinstance(token, str) and token for token in stop_tokens):
+        raise ValueError('stop_tokens must be a list of strings')
+    args['stop_tokens'] = stop_tokens
+
+    args['depth'] = min(max(args['depth'], 1), LLOOM_SERVE_MAX_DEPTH)
+    if args['max_beams'] <= 0 or args['max_beams'] > LLOOM_SERVE_MAX_BEAMS:
+        args['max_beams'] = LLOOM_SERVE_MAX_BEAMS
+    if LLOOM_SERVE_DEADLINE > 0:
+        args['deadline'] = min(args['deadline'] or LLOOM_SERVE_DEADLINE, LLOOM_SERVE_DEADLINE)
+    return args
+
+def query_params(query):
+    # ?prompt=...&depth=8&stop_tokens=.&stop_tokens=, for EventSource, which can only GET
+    values = parse_qs(query)
+    params = { name: value[-1] for name, value in values.items() if name != 'stop_tokens' }
+    params['stop_tokens'] = values.get('stop_tokens', [])
+    return params
+
+class ExploreService:
+    # what the clients share: the backend and its pool, the request limiter and the worker threads.
+    # Searches submit their requests to one pool in the order they become ready, so concurrent
+    # explores take turns on the backend instead of one of them filling every slot.
+
+    def __init__(self, concurrency, backend=None):
+        self.concurrency = concurrency
+        self.backend = open_backend(concurrency, backend)
+        self.limiter = adaptive_limiter(self.backend, concurrency) if LLOOM_ADAPTIVE else threading.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=worker_count(self.limiter, concurrency))
+        self.lock = threading.Lock()
+        self.active = 0
+        self.served = 0
+
+    def run(self, args, cancel, events):
+        # runs one explore on its own thread, putting ('beam' | 'done' | 'error', data) on events
+        stats = SearchStats()
+        prompt = args['prompt']
+        with self.lock:
+            self.active += 1
+        try:
+            search = parallel_lloom_search(prompt, args['depth'], args['max_beams'], args['stop_tokens'], args['cutoff'], args['multiplier'], args['maxsplits'], self.concurrency,
+                                           stats=stats, cancel=cancel, deadline=args['deadline'], max_requests=args['max_requests'], backend=self.backend, limiter=self.limiter, executor=self.executor)
+            for prob, thread, level in search:
+                events.put(('beam', { 'probability': prob, 'text': thread[len(prompt):], 'depth': level }))
+            events.put(('done', stats.summary()))
+        except Exception as e:
+            events.put(('error', { 'error': str(e) }))
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.served += 1
+
+    def stats(self):
+        cache = get_logprob_cache()
+        with self.lock:
+            return {
+                'model': self.backend.display_name(),
+                'active': self.active,
+                'served': self.served,
+                'slots': request_slots(self.limiter, self.concurrency),
+                'cache': cache.stats() if cache is not None else None,
+            }
+
+class ExploreHandler(BaseHTTPRequestHandler):
+    # GET /explore?prompt=... or POST /explore with a JSON body streams the search, GET /stats reports the service
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/explore':
+            self.explore(query_params(url.query))
+        elif url.path == '/stats':
+            self.send_json(200, self.server.service.stats())
+        else:
+            self.send_json(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/explore':
+            self.send_json(404, { 'error': 'not found' })
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except (ValueError, UnicodeDecodeError):
+            self.send_json(400, { 'error': 'body must be JSON' })
+            return
+        if not isinstance(params, dict):
+            self.send_json(400, { 'error': 'body must be a JSON object' })
+            return
+        self.explore(params)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, kind, data):
+        self.wfile.write(f'event: {kind}\ndata: {json.dumps(data)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def explore(self, params):
+        try:
+            args = explore_args(params)
+        except ValueError as e:
+            self.send_json(400, { 'error': str(e) })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        events = queue.Queue()
+        cancel = threading.Event()
+        threading.Thread(target=self.server.service.run, args=(args, cancel, events), daemon=True).start()
+        try:
+            while True:
+                try:
+                    kind, data = events.get(timeout=LLOOM_SERVE_HEARTBEAT)
+                except queue.Empty:
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+                    continue
+                self.send_event(kind, data)
+                if kind != 'beam':
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, its search stops at the next poll and drops its queued requests
+            pass
+        finally:
+            cancel.set()
+
+def main():
+    service = ExploreService(LLOOM_SERVE_CONCURRENCY, resolve_backend())
+    server = ThreadingHTTPServer((LLOOM_SERVE_HOST, LLOOM_SERVE_PORT), ExploreHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Serving {service.backend.display_name()} on http://{LLOOM_SERVE_HOST}:{LLOOM_SERVE_PORT}, {LLOOM_SERVE_CONCURRENCY} requests in flight")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    main()
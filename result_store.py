@@ -0,0 +1,55 @@
+import os
+import time
+
+# Root of a Parquet dataset that sweeps write into, partitioned as model=<name>/story=<key>/.
+# Unset means results only go to the CSV files. Requires `pip3 install pyarrow`.
+LLOOM_RESULTS_PATH = os.getenv('LLOOM_RESULTS_PATH')
+
+def partition_path(root, model, story_key):
+    # hive-style directories, so readers can prune by model and story without opening any files
+    return os.path.join(root, f'model={model}', f'story={story_key}')
+
+def write_story_results(root, model, story_key, story, threads, summary):
+    # threads are (probability, text, depth) best first, summary is SearchStats.summary()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    count = len(threads)
+    table = pa.table({
+        'rank': pa.array(range(count), pa.int32()),
+        'probability': pa.array([ float(prob) for prob, text, depth in threads ], pa.float64()),
+        'thread': pa.array([ text for prob, text, depth in threads ], pa.string()),
+        'depth': pa.array([ int(depth) for prob, text, depth in threads ], pa.int32()),
+        # the search that found them, repeated per row so any slice of the dataset carries it
+        'story_chars': pa.array([len(story)] * count, pa.int32()),
+        'requests': pa.array([summary['requests']] * count, pa.int32()),
+        'tokens': pa.array([summary['tokens']] * count, pa.int32()),
+        'seconds': pa.array([summary['seconds']] * count, pa.float64()),
+        'tokens_per_sec': pa.array([summary['tokens_per_sec']] * count, pa.float64()),
+        'queue_ms_mean': pa.array([summary['queue_ms_mean']] * count, pa.float64()),
+        'network_ms_p50': pa.array([summary['network_ms_p50']] * count, pa.float64()),
+        'network_ms_p95': pa.array([summary['network_ms_p95']] * count, pa.float64()),
+        'server_ms_mean': pa.array([summary['server_ms_mean']] * count, pa.float64()),
+        'cache_hits': pa.array([summary['cache_hits']] * count, pa.int32()),
+        'finished_at': pa.array([time.time()] * count, pa.float64()),
+    })
+
+    path = partition_path(root, model, story_key)
+    os.makedirs(path, exist_ok=True)
+    # one file per (model, story): a re-run replaces it, written aside first so readers never see half of it
+    tmp_file = os.path.join(path, '.part-0.parquet.tmp')
+    pq.write_table(table, tmp_file)
+    os.replace(tmp_file, os.path.join(path, 'part-0.parquet'))
+
+def read_results(root, models=None, story_keys=None, columns=None):
+    # the dataset as a pandas DataFrame with model and story columns, filtered before anything is read
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(root, format='parquet', partitioning='hive')
+    expression = None
+    if models is not None:
+        expression = ds.field('model').isin(models)
+    if story_keys is not None:
+        story_filter = ds.field('story').isin(story_keys)
+        expression = story_filter if expression is None else expression & story_filter
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
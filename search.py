@@ -1,224 +1,716 @@
-import numpy as np
 import os
+import time
+import threading
+from logprob_cache import get_logprob_cache
+from token_tree import TokenTree
+from backends import SimpleProbability, resolve_backend, get_model_name
+from search_stats import SearchStats, report_cache_lookup
 global t_model
-openai_client = None
-def get_logprobs_openai(prompt, model="gpt-3.5-turbo"):
-    global openai_client
-    if openai_client is None:
-        from openai import OpenAI
-        openai_client = OpenAI()
-    
-    messages = [{'role': 'user', 'content': prompt}]
-    response = openai_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0.7,
-        max_tokens=1,
-        logprobs=True,
-        top_logprobs=10,
-        n=1
-    )
-    
-    top_logprobs = response.choices[0].logprobs.content[0].top_logprobs
-    for logprob in top_logprobs:
-        logprob.probability = np.exp(logprob.logprob)
-        
-    return top_logprobs
-
-class SimpleProbability:
-    def __init__(self, token, probability):
-        self.token = token
-        self.probability = probability
-
-def get_model_name():
-    if os.getenv('LLAMA_API_URL') is not None:
-        import requests
-        base_url = os.getenv('LLAMA_API_URL')
-        models = requests.get(base_url+'/v1/models').json()
-        modelname, extension = os.path.splitext(os.path.basename(models['data'][0]['id'] ))
-        return modelname
-    
-    elif os.getenv('KOBOLD_API_URL') is not None:
-        import requests
-        base_url = os.getenv('KOBOLD_API_URL')
-        models = requests.get(base_url+'/v1/models').json()
-        modelname, extension = os.path.splitext(os.path.basename(models['data'][0]['id'] ))
-        return modelname
-    else:
-        return ""
-
-## doh! no log probs from Kobold!
-def get_logprobs_kobold(prompt, base_url):
-    import requests
-       
-    url = base_url+'/v1/completions'
-    payload = { 'prompt': prompt,
-            'cache_prompt': True,
-            'temperature': 1.0,
-            'n_predict': 1,
-            'top_k': 10,
-            'top_p': 1.0,
-            'n_probs': 10
-           }
-    
-    response = requests.post(url, json=payload)
-    response_json = response.json()
-    probs = response_json['completion_probabilities'][0]['probs']
-
-
-    return [ SimpleProbability(prob['tok_str'], prob['prob']) for prob in probs]
-
-def get_logprobs_llama(prompt, base_url):
-    import requests
-       
-    url = base_url+'/completion'
-    payload = { 'prompt': prompt,
-            'cache_prompt': True,
-            'temperature': 1.0,
-            'n_predict': 1,
-            'top_k': 10,
-            'top_p': 1.0,
-            'n_probs': 10
-           }
-    
-    response = requests.post(url, json=payload)
 
-    try:
-        response_json = response.json()
-    
-        if 'completion_probabilities' in response_json and response_json['completion_probabilities']:
-            if 'probs' in response_json['completion_probabilities'][0]:
-                probs = response_json['completion_probabilities'][0]['probs']
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Set LLOOM_VERBOSE to print every request a search sends
+LLOOM_VERBOSE = os.getenv('LLOOM_VERBOSE') is not None
+
+def token_ids_enabled(backend):
+    # LLOOM_TOKEN_IDS sends prompts as token id arrays, for backends that accept them
+    return os.getenv('LLOOM_TOKEN_IDS') is not None and backend.supports_token_ids
+
+def open_backend(parallelism, backend=None):
+    # the backend is picked once per search, its pools sized and the cache key's model name looked up
+    backend = backend if backend is not None else resolve_backend()
+    backend.open(parallelism)
+    if get_logprob_cache() is not None:
+        backend.cache_signature()
+    return backend
+
+def cached_logprobs(backend, prompt):
+    # returns (cache, key, logprobs), logprobs is None on a miss. An empty entry, written for a failed
+    # request before those were kept out, is a miss too.
+    cache = get_logprob_cache()
+    if cache is None:
+        report_cache_lookup(False)
+        return None, None, None
+
+    (name, model, params) = backend.cache_signature()
+    key = cache.make_key(name, model, prompt, params)
+    value = cache.get(key)
+    report_cache_lookup(bool(value))
+    if not value:
+        return cache, key, None
+    return cache, key, [ SimpleProbability(*entry) for entry in value ]
+
+def store_logprobs(cache, key, logprobs):
+    # logprobs is None (or empty) when the request failed, which is left for the next search to retry
+    if cache is not None and logprobs:
+        cache.put(key, [ (logprob.token, float(logprob.probability), getattr(logprob, 'token_id', None)) for logprob in logprobs ])
+
+def parallel_get_logprobs(backend, request_prompt):
+    # request_prompt is the beam's text or token ids, returns (logprobs, following)
+    cache, key, logprobs = cached_logprobs(backend, request_prompt)
+    if logprobs is not None:
+        return (logprobs, [])
+
+    logprobs = backend.get_logprobs(request_prompt)
+    store_logprobs(cache, key, logprobs)
+    return (logprobs, [])
+
+# how many prompts may share one request, for backends that accept a list of prompts
+LLOOM_BATCH_SIZE = int(os.getenv('LLOOM_BATCH_SIZE', 1))
+
+def beam_prompts(tree, nodes):
+    # what goes on the wire for a batch of beams, the token ids when every one of them has them
+    # (mixing them with text would change how the server reads the list), otherwise their text
+    token_ids = [ tree.token_ids(node) for node in nodes ]
+    if all(ids is not None for ids in token_ids):
+        return token_ids
+    return [ tree.text(node) for node in nodes ]
+
+def batch_misses(backend, request_prompts):
+    # looks every prompt of a batch up in the cache, returns (results, misses)
+    results = [None] * len(request_prompts)
+    misses = []
+    for i, request_prompt in enumerate(request_prompts):
+        cache, key, logprobs = cached_logprobs(backend, request_prompt)
+        if logprobs is None:
+            misses.append((i, cache, key))
+        results[i] = logprobs
+    return results, misses
+
+# Set LLOOM_SPECULATE=4 to have a beam whose parent didn't split ask for up to 4 greedy tokens in one request,
+# the distributions after the first fill in the tree below it so the beam only costs a request where it splits
+LLOOM_SPECULATE = int(os.getenv('LLOOM_SPECULATE', 0))
+
+def lookahead(node, level, max_depth, initial_cutoff, multiplier, maxsplits):
+    # how many tokens to ask for when expanding node: one, unless its parent's distribution had no alternative
+    # above the cutoff, in which case this stretch of text probably doesn't branch either
+    parent = node.parent
+    if LLOOM_SPECULATE <= 1 or parent is None or parent.logprobs is None:
+        return 1
+    if len(split_beam(parent.logprobs, initial_cutoff * multiplier ** (level - 1), maxsplits)) > 1:
+        return 1
+    return max(min(LLOOM_SPECULATE, max_depth - level + 1), 1)
+
+def continued_prompt(request_prompt, logprob):
+    # the prompt after the greedy token, None if it can't be expressed
+    if isinstance(request_prompt, list):
+        return request_prompt + [logprob.token_id] if getattr(logprob, 'token_id', None) is not None else None
+    return request_prompt + logprob.token
+
+def store_following(backend, request_prompt, logprobs, following):
+    # a continuation's later distributions are cached under the prompts the search would look them up by
+    cache = get_logprob_cache()
+    if cache is None:
+        return
+    (name, model, params) = backend.cache_signature()
+    for next_logprobs in following:
+        request_prompt = continued_prompt(request_prompt, logprobs[0]) if logprobs else None
+        if request_prompt is None:
+            break
+        store_logprobs(cache, cache.make_key(name, model, request_prompt, params), next_logprobs)
+        logprobs = next_logprobs
+
+def store_continuations(backend, request_prompts, misses, batch, results, following):
+    # fills in results and following for the prompts a continuation request was sent for
+    for (i, cache, key), positions in zip(misses, batch):
+        results[i], following[i] = (positions[0], positions[1:]) if positions else (None, [])
+        store_logprobs(cache, key, results[i])
+        store_following(backend, request_prompts[i], results[i], following[i])
+
+def parallel_get_logprobs_batch(backend, request_prompts, length=1):
+    # results come back as (logprobs, following) in the order of request_prompts, following being the
+    # distributions along a greedy continuation when length asked for one
+    if length > 1 and backend.supports_continuation:
+        results, misses = batch_misses(backend, request_prompts)
+        following = [[] for _ in request_prompts]
+        if misses:
+            batch = backend.get_continuation_batch([ request_prompts[i] for i, _, _ in misses ], length)
+            store_continuations(backend, request_prompts, misses, batch, results, following)
+        return list(zip(results, following))
+
+    if len(request_prompts) == 1 or not backend.supports_batching:
+        return [ parallel_get_logprobs(backend, request_prompt) for request_prompt in request_prompts ]
+
+    results, misses = batch_misses(backend, request_prompts)
+    if misses:
+        batch = backend.get_logprobs_batch([ request_prompts[i] for i, _, _ in misses ])
+        for (i, cache, key), logprobs in zip(misses, batch):
+            store_logprobs(cache, key, logprobs)
+            results[i] = logprobs
+
+    return [ (logprobs, []) for logprobs in results ]
+
+# Set LLOOM_ADAPTIVE to let the threaded searches find each server's request concurrency themselves:
+# starting from the parallelism asked for, up to LLOOM_ADAPTIVE_MAX requests in flight, backing off
+# when responses take over LLOOM_ADAPTIVE_TOLERANCE times the fastest one seen or the server sends 429/503
+LLOOM_ADAPTIVE = os.getenv('LLOOM_ADAPTIVE') is not None
+LLOOM_ADAPTIVE_MAX = int(os.getenv('LLOOM_ADAPTIVE_MAX', 32))
+LLOOM_ADAPTIVE_TOLERANCE = float(os.getenv('LLOOM_ADAPTIVE_TOLERANCE', 2.0))
+
+class AdaptiveLimiter:
+    # a semaphore that resizes itself AIMD style: one more slot for every window of requests that came
+    # back in time, a quarter fewer when one was slow or turned away. Safe to share between searches.
+
+    def __init__(self, initial, maximum=LLOOM_ADAPTIVE_MAX, minimum=1, tolerance=LLOOM_ADAPTIVE_TOLERANCE):
+        self.condition = threading.Condition()
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.tolerance = tolerance
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.fastest_ms = None
+        self.decreased_at = 0.0
+
+    def slots(self):
+        return int(self.limit)
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < self.slots())
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def observe(self, latency_ms, overloaded=False):
+        with self.condition:
+            if self.fastest_ms is None or self.slots() <= self.minimum:
+                # with nothing left to back off there's no queue to blame, this is what the server takes now
+                self.fastest_ms = latency_ms
             else:
-                print("Warning: 'probs' key not found in the first completion probability.")
-                probs = []
+                # the baseline creeps up a little with every response so it can follow prompts getting longer
+                self.fastest_ms = min(latency_ms, self.fastest_ms * 1.005)
+            if overloaded or latency_ms > self.fastest_ms * self.tolerance:
+                # once per round trip, the other slow responses were sent before the last decrease
+                if time.time() - self.decreased_at > latency_ms / 1000:
+                    self.limit = max(self.minimum, self.limit * 0.75)
+                    self.decreased_at = time.time()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+# one limiter per backend instance, so what it learned carries over to the next search on that server
+adaptive_limiters = {}
+adaptive_lock = threading.Lock()
+
+def adaptive_limiter(backend, parallelism):
+    with adaptive_lock:
+        if backend not in adaptive_limiters:
+            adaptive_limiters[backend] = AdaptiveLimiter(parallelism)
+        return adaptive_limiters[backend]
+
+def request_limiter(backend, parallelism, limiter=None):
+    # the caller's limiter, else the backend's adaptive one when LLOOM_ADAPTIVE is set
+    if limiter is None and LLOOM_ADAPTIVE:
+        return adaptive_limiter(backend, parallelism)
+    return limiter
+
+def request_slots(limiter, parallelism):
+    # how many requests a search keeps in flight right now
+    return limiter.slots() if isinstance(limiter, AdaptiveLimiter) else parallelism
+
+def worker_count(limiter, parallelism):
+    return max(parallelism, limiter.maximum) if isinstance(limiter, AdaptiveLimiter) else parallelism
+
+def timed_get_logprobs_batch(backend, request_prompts, stats, queued_at, limiter=None, length=1):
+    # runs on the worker thread so the backend and cache can report into this request's record,
+    # limiter is a semaphore shared by searches that must not overload one server between them
+    if limiter is not None:
+        limiter.acquire()
+    record = stats.begin(len(request_prompts), queued_at)
+    try:
+        return parallel_get_logprobs_batch(backend, request_prompts, length)
+    finally:
+        stats.end(record)
+        if limiter is not None:
+            # an adaptive limiter learns from every request that reached the server
+            if isinstance(limiter, AdaptiveLimiter) and record['cache_misses']:
+                limiter.observe((record['end'] - record['start']) * 1000, record.get('retries', 0) > 0)
+            limiter.release()
+
+def split_beam(logprobs, cutoff, maxsplits):
+    # the top token always continues the beam, the rest only split off if they beat the cutoff
+    children = []
+    for logprob_choice in logprobs:
+        if len(children) > 0 and logprob_choice.probability < cutoff: break
+        if maxsplits > 0 and len(children) == maxsplits: break
+        children.append(logprob_choice)
+    return children
+
+def stop_beam(new_tokens, stop_tokens):
+    # returns how much of the generated text to keep if it hit a stop token, otherwise None
+    stop_search_tokens = new_tokens
+
+    for st in stop_tokens:
+        # starting with a stop token is OK, keep searching until there's some meat
+        if stop_search_tokens[0:len(st)] == st: 
+            stop_search_tokens = stop_search_tokens[len(st):]
+
+        if st in stop_search_tokens:
+            return new_tokens.find(st)+1
+
+    return None
+
+class StopTracker:
+    # Applies stop_beam to a search's beams one new token at a time instead of rescanning their text. What
+    # stop_beam decides only depends on the first few generated characters (where leading stop tokens are
+    # skipped) and on the last few (where a stop token split across tokens starts), so every node the
+    # search reaches keeps (head, tail, length) of its generated text. It lives with the search rather than
+    # on the tree, which later searches may reuse with other stop tokens.
+
+    def __init__(self, tree, stop_tokens):
+        self.tree = tree
+        self.stop_tokens = stop_tokens
+        longest = max((len(st) for st in stop_tokens), default=0)
+        # past this many characters every leading stop token is settled and behind the tail
+        self.head_chars = sum(len(st) for st in stop_tokens) + longest
+        self.tail_chars = max(longest - 1, 0)
+        self.states = {}
+
+    def state(self, node):
+        state = self.states.get(node)
+        if state is None:
+            # the root, whose text is the prompt alone, or a node the search started from
+            suffix = self.tree.suffix(node)
+            state = (suffix[:self.head_chars], suffix[max(len(suffix) - self.tail_chars, 0):], len(suffix))
+        return state
+
+    def check(self, node, child):
+        # the trimmed beam's text if child, one token below node, hit a stop token, otherwise None
+        if not self.stop_tokens:
+            return None
+        head, tail, length = self.state(node)
+        token = child.token
+
+        if length < self.head_chars:
+            # short enough that head is all of it
+            new_tokens = head + token
+            cut = stop_beam(new_tokens, self.stop_tokens)
+            if cut is not None:
+                return self.tree.prompt + new_tokens[:cut]
+            self.states[child] = (new_tokens[:self.head_chars], new_tokens[max(len(new_tokens) - self.tail_chars, 0):], len(new_tokens))
+            return None
+
+        # node didn't stop, so a stop token can only be one that ends in the new token
+        window = tail + token
+        for st in self.stop_tokens:
+            if st in window:
+                # stop_beam cuts at the first occurrence, which is in the head if there's one there
+                cut = head.find(st) + 1
+                if cut > 0:
+                    return self.tree.prompt + head[:cut]
+                cut = length - len(tail) + window.find(st) + 1
+                return self.tree.prompt + self.tree.suffix(child)[:cut]
+        self.states[child] = (head, window[max(len(window) - self.tail_chars, 0):], length + len(token))
+        return None
+
+    def expanded(self, node):
+        # every child of node has been checked
+        self.states.pop(node, None)
+
+def known_logprobs(node):
+    # a node expanded by an earlier search on the same tree doesn't need another request
+    from concurrent.futures import Future
+
+    future = Future()
+    future.set_result([(node.logprobs, [])])
+    return future
+
+def grow_following(tree, node, following):
+    # distributions from a continuation request belong to the greedy path below node, where they
+    # turn the nodes on it into known ones
+    for logprobs in following:
+        if not node.logprobs:
+            break
+        top = node.logprobs[0]
+        node = tree.child(node, top.token, top.probability, getattr(top, 'token_id', None))
+        if node.logprobs is None and logprobs:
+            node.logprobs = logprobs
+
+def expand_beam(tree, node, level, logprobs, following, stats, max_depth, stops, cutoff, maxsplits, room=None):
+    # records node's distribution and splits it into (choice, child node, text) per child, in order: text is
+    # the finished beam to yield when the child ends its beam here, None when it keeps growing and is to be
+    # submitted. When room is given only that many children may keep growing, the rest end at this token
+    # like they would at max_depth.
+    # a failed request (logprobs None) ends the beam without children
+    choices = split_beam(logprobs or [], cutoff, maxsplits)
+    stats.expanded(level, len(choices), known=node.logprobs is not None)
+    # only a distribution that came back is kept, a failed node is asked again by the next search
+    if logprobs:
+        node.logprobs = logprobs
+    grow_following(tree, node, following)
+
+    children = []
+    for i, logprob_choice in enumerate(choices):
+        child = tree.child(node, logprob_choice.token, logprob_choice.probability, getattr(logprob_choice, 'token_id', None))
+        if level == max_depth or (room is not None and i >= room):
+            children.append((logprob_choice, child, tree.text(child)))
         else:
-            print("Warning: 'completion_probabilities' is empty or not present in the response.")
-            probs = []
-
-    except json.JSONDecodeError:
-        print("Error: Failed to decode JSON from the response.")
-        probs = []
-    except IndexError:
-        print("Error: 'completion_probabilities' list is empty.")
-        probs = []
-    except KeyError as e:
-        print(f"Error: Expected key not found in JSON response: {e}")
-        probs = []
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        probs = []
-
-    # Now you can safely use 'probs'
-    #print(f"Number of probabilities: {len(probs)}")
-    #print(probs)
-
-    return [ SimpleProbability(prob['tok_str'], prob['prob']) for prob in probs]
-
-vllm_model_name = None
-def get_logprobs_vllm(prompt, base_url):
-    import requests
-    
-    global vllm_model_name
-    if vllm_model_name is None:
-        models = requests.get(base_url+'/v1/models').json()
-        vllm_model_name = models['data'][0]['id']
-        print('VLLM model name:', vllm_model_name)
-       
-    url = base_url+'/v1/completions'
-    payload = {
-        "prompt": prompt,
-        "n": 1,
-        "temperature": 0.0,
-        "max_tokens": 1,
-        "stream": False,
-        "logprobs": 5,
-        "model": vllm_model_name
-    }
-
-    response = requests.post(url, json=payload)
-    probs = response.json()['choices'][0]['logprobs']['top_logprobs'][0]
-    return [ SimpleProbability(k,np.exp(v)) for k,v in probs.items()]
-
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def parallel_get_logprobs(prompt, acc):
-    # Choose which API to use based on environment variables
-    if os.getenv('LLAMA_API_URL') is not None:
-        logprobs =  get_logprobs_llama(prompt, os.getenv('LLAMA_API_URL'))
-    elif os.getenv('KOBOLD_API_URL') is not None:
-        logprobs =  get_logprobs_kobold(prompt, os.getenv('KOBOLD_API_URL'))
-    elif os.getenv('VLLM_API_URL') is not None:
-        logprobs =  get_logprobs_vllm(prompt, os.getenv('VLLM_API_URL'))
-    elif os.getenv('OPENAI_API_KEY') is not None:
-        logprobs = get_logprobs_openai(prompt)
-    else:
-        raise Exception('Please set either OPENAI_API_KEY or LLAMA_API_URL')       
-    
-    return (prompt, acc, logprobs)
-
-def parallel_lloom_search(initial_prompt, max_depth, max_beams, stop_tokens, initial_cutoff, multiplier, maxsplits, parallelism=2):
-    
-    tasks = [(initial_prompt, 0.0)]
-    cutoff = initial_cutoff
-    depth = max_depth
+            children.append((logprob_choice, child, stops.check(node, child)))
+    stops.expanded(node)
+    return children
+
+# how often a search blocked on the backend checks its cancel token
+CANCEL_POLL = 0.05
+
+def search_deadline(deadline):
+    # deadline is in seconds from now
+    return time.time() + deadline if deadline else None
+
+def interrupted(cancel, deadline_at):
+    # cancel is anything with is_set(), such as a threading.Event
+    return (cancel is not None and cancel.is_set()) or (deadline_at is not None and time.time() >= deadline_at)
+
+def wait_timeout(cancel, deadline_at):
+    # how long to block on in-flight requests before checking again, None to wait for one to finish
+    timeout = CANCEL_POLL if cancel is not None else None
+    if deadline_at is not None:
+        remaining = max(deadline_at - time.time(), 0)
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    return timeout
+
+def unfinished_beams(tree, beams, max_beams, done_beams):
+    # beams are the (acc, level, node) still growing when the search stopped, reported most probable
+    # first like a finished beam of the tokens they have so far
+    beams = sorted((beam for beam in beams if beam[1] > 0), key=lambda beam: beam[0], reverse=True)
+    if max_beams > 0:
+        beams = beams[:max(max_beams - done_beams, 0)]
+    return [ (acc, tree.text(node), level - 1) for acc, level, node in beams ]
+
+def search_tree(backend, tree, initial_prompt):
+    # reuse the caller's tree when it is rooted at this prompt, otherwise start a fresh one
+    if tree is None or tree.prompt != initial_prompt:
+        tree = TokenTree(initial_prompt)
+    # the story is tokenized once, after that prompts grow by the ids the model produced
+    if tree.prompt_ids is None and token_ids_enabled(backend):
+        tree.prompt_ids = backend.tokenize(initial_prompt)
+    return tree
+
+def parallel_lloom_search(initial_prompt, max_depth, max_beams, stop_tokens, initial_cutoff, multiplier, maxsplits, parallelism=2, tree=None, batch_size=None, stats=None, cancel=None, deadline=None, max_requests=None, backend=None, limiter=None, executor=None):
+    # cancel (a threading.Event), deadline (seconds) and max_requests stop the search early, the beams
+    # it was still growing are then returned as they are. executor is a pool shared with other searches,
+    # by default the search runs its requests on its own.
+    deadline_at = search_deadline(deadline)
+    stats = stats if stats is not None else SearchStats()
+    backend = resolve_backend() if backend is None else backend
+    limiter = request_limiter(backend, parallelism, limiter)
+    backend = open_backend(worker_count(limiter, parallelism), backend)
+    tree = search_tree(backend, tree, initial_prompt)
+    stops = StopTracker(tree, stop_tokens)
+    batch_size = (batch_size or LLOOM_BATCH_SIZE) if backend.supports_batching else 1
     done_beams = 0
 
-    with ThreadPoolExecutor(max_workers=parallelism) as executor:
-        while tasks:
-            # spawn futures
-            futures = []
-            for task in tasks:
-                print("spawning depth:", depth ,"task:", task)
-                futures.append(executor.submit(parallel_get_logprobs, *task))
-                
-            total_futures = len(tasks)
-            tasks = []
-            done_futures = 0
-
-            # process futures as they come in
-            for future in as_completed(futures):
-                res = future.result()
-                (prompt, acc, logprobs) = res
-
-                count = 0
-                for logprob_choice in logprobs:
-                    token = logprob_choice.token
-                    probability = logprob_choice.probability
-
-                    if count > 0 and probability < cutoff: break        
-                    if maxsplits > 0 and count == maxsplits: break
-
-                    count += 1
-
-                    new_prompt = prompt + token
-                    early_finish = False
-
-                    if depth == 0 or ((max_beams > 0) and (done_beams+total_futures-done_futures >= max_beams)):
-                        yield (acc + probability, new_prompt, max_depth - depth)
-                        early_finish = True
-                    else:
-                        new_tokens = new_prompt[len(initial_prompt):]
-                        stop_search_tokens = new_tokens
-                        
-                        for st in stop_tokens:
-                            # starting with a stop token is OK, keep searching until there's some meat
-                            if stop_search_tokens[0:len(st)] == st: 
-                                stop_search_tokens = stop_search_tokens[len(st):]
-
-                            if (not early_finish) and (st in stop_search_tokens):
-                                trimmed_prompt = initial_prompt + new_tokens[:new_tokens.find(st)+1]
-                                yield (acc + probability, trimmed_prompt, max_depth - depth)
-                                early_finish = True
-
-                    if not early_finish:
-                        new_task =(new_prompt, acc + probability)
-                        tasks.append(new_task)
-                    else:
-                        done_beams += 1
-                        
-                done_futures += 1
-            
-            # adjust for next cycle            
-            cutoff = cutoff * multiplier
-            depth = depth - 1
+    # an own pool is shut down without waiting in the finally below, so an abandoned search returns straight away
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=worker_count(limiter, parallelism))
+    # beams waiting for a free request slot as (acc, level, tree node, queued at), in-flight requests with
+    # the beams in their batch, and how many beams are queued or in flight
+    queue = deque()
+    futures = {}
+    outstanding = 0
+    requests = 0
+
+    def submit(acc, level, node):
+        nonlocal outstanding
+        outstanding += 1
+        if node.logprobs is not None:
+            futures[known_logprobs(node)] = [(acc, level, node, None)]
+            return
+        queue.append((acc, level, node, time.time()))
+
+    def dispatch():
+        nonlocal requests
+        # whatever piled up while every slot was busy goes out together, up to batch_size per request
+        while queue and len(futures) < request_slots(limiter, parallelism) and (max_requests is None or requests < max_requests) and not interrupted(cancel, deadline_at):
+            batch = [ queue.popleft() for _ in range(min(batch_size, len(queue))) ]
+            if LLOOM_VERBOSE:
+                for acc, level, node, queued_at in batch:
+                    print("spawning depth:", max_depth - level, "task:", (tree.suffix(node), acc))
+            request_prompts = beam_prompts(tree, [ node for acc, level, node, queued_at in batch ])
+            length = max(lookahead(node, level, max_depth, initial_cutoff, multiplier, maxsplits) for acc, level, node, queued_at in batch)
+            futures[executor.submit(timed_get_logprobs_batch, backend, request_prompts, stats, batch[0][3], limiter, length)] = batch
+            stats.dispatched(len(futures), request_slots(limiter, parallelism))
+            requests += 1
+
+    submit(0.0, 0, tree.root)
+    dispatch()
+
+    try:
+        # no per-depth barrier: children are submitted as soon as their parent's logprobs arrive
+        while futures and not interrupted(cancel, deadline_at):
+            done, _ = wait(futures, timeout=wait_timeout(cancel, deadline_at), return_when=FIRST_COMPLETED)
+            for future in done:
+                for (acc, level, node, _), (logprobs, following) in zip(futures[future], future.result()):
+                    # every outstanding beam (this one included) will produce at least one more
+                    room = max_beams - done_beams - outstanding if max_beams > 0 else None
+                    for logprob_choice, child, text in expand_beam(tree, node, level, logprobs, following, stats, max_depth, stops, initial_cutoff * multiplier ** level, maxsplits, room):
+                        if text is not None:
+                            stats.beam()
+                            yield (acc + logprob_choice.probability, text, level)
+                            done_beams += 1
+                        else:
+                            submit(acc + logprob_choice.probability, level + 1, child)
+
+                    outstanding -= 1
+
+                del futures[future]
+            dispatch()
+
+        # stopped early: whatever was still queued or in flight is the best there is
+        pending = [ (acc, level, node) for batch in [queue, *futures.values()] for acc, level, node, queued_at in batch ]
+        for beam in unfinished_beams(tree, pending, max_beams, done_beams):
+            stats.beam()
+            yield beam
+    finally:
+        # consumer stopped early or a request failed: drop whatever hasn't started yet, requests
+        # already on the wire finish in the background and still fill the logprob cache
+        queue.clear()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            # a shared pool keeps running other searches' requests, only this one's are dropped
+            for future in futures:
+                future.cancel()
+        stats.finish()
+
+def best_first_lloom_search(initial_prompt, max_depth, max_beams, stop_tokens, initial_cutoff, multiplier, maxsplits, parallelism=2, max_requests=100, tree=None, stats=None, cancel=None, deadline=None, backend=None, limiter=None):
+    # always expand the frontier node with the highest cumulative log-probability, stopping once
+    # max_requests have been spent or the top max_beams completions can no longer be beaten
+    import heapq
+    import itertools
+    import math
+
+    deadline_at = search_deadline(deadline)
+    stats = stats if stats is not None else SearchStats()
+    backend = resolve_backend() if backend is None else backend
+    limiter = request_limiter(backend, parallelism, limiter)
+    backend = open_backend(worker_count(limiter, parallelism), backend)
+    tree = search_tree(backend, tree, initial_prompt)
+    stops = StopTracker(tree, stop_tokens)
+    # max-heap (by negated log-probability) of (-logprob, tiebreak, level, tree node, queued at)
+    frontier = [(0.0, 0, 0, tree.root, time.time())]
+    tiebreak = itertools.count(1)
+    # min-heap holding the log-probabilities of the best max_beams finished beams
+    best_finals = []
+    finished = 0
+    requests = 0
+
+    executor = ThreadPoolExecutor(max_workers=worker_count(limiter, parallelism))
+    # in-flight requests and the (level, logprob, tree node) of the beam each one is expanding
+    futures = {}
+
+    def settled():
+        # log-probabilities only shrink as beams grow, so nothing unexpanded can beat the current top-K
+        if max_beams <= 0 or len(best_finals) < max_beams:
+            return False
+        bound = -frontier[0][0] if frontier else -math.inf
+        for level, logprob, node in futures.values():
+            bound = max(bound, logprob)
+        return best_finals[0] >= bound
+
+    try:
+        while not interrupted(cancel, deadline_at):
+            while frontier and len(futures) < request_slots(limiter, parallelism) and requests < max_requests and not settled():
+                (neg_logprob, _, level, node, queued_at) = heapq.heappop(frontier)
+                logprob = -neg_logprob
+                if node.logprobs is not None:
+                    futures[known_logprobs(node)] = (level, logprob, node)
+                    continue
+                if LLOOM_VERBOSE:
+                    print("spawning depth:", max_depth - level, "task:", (tree.suffix(node), logprob))
+                length = lookahead(node, level, max_depth, initial_cutoff, multiplier, maxsplits)
+                futures[executor.submit(timed_get_logprobs_batch, backend, beam_prompts(tree, [node]), stats, queued_at, limiter, length)] = (level, logprob, node)
+                stats.dispatched(len(futures), request_slots(limiter, parallelism))
+                requests += 1
+
+            if not futures:
+                break
+
+            done, _ = wait(futures, timeout=wait_timeout(cancel, deadline_at), return_when=FIRST_COMPLETED)
+            for future in done:
+                (level, logprob, node) = futures.pop(future)
+                (logprobs, following) = future.result()[0]
+                for logprob_choice, child, text in expand_beam(tree, node, level, logprobs, following, stats, max_depth, stops, initial_cutoff * multiplier ** level, maxsplits):
+                    new_logprob = logprob + math.log(max(logprob_choice.probability, 1e-12))
+                    if text is not None:
+                        stats.beam()
+                        yield (math.exp(new_logprob), text, level)
+                        finished += 1
+                        heapq.heappush(best_finals, new_logprob)
+                        if max_beams > 0 and len(best_finals) > max_beams:
+                            heapq.heappop(best_finals)
+                    elif max_beams <= 0 or len(best_finals) < max_beams or new_logprob >= best_finals[0]:
+                        # once the top max_beams are in, a beam below the worst of them can't get in any more
+                        heapq.heappush(frontier, (-new_logprob, next(tiebreak), level + 1, child, time.time()))
+
+        # cancelled: the beams that were being expanded are unfinished ones too
+        for level, logprob, node in futures.values():
+            heapq.heappush(frontier, (-logprob, next(tiebreak), level, node, 0))
+
+        # budget ran out before enough beams finished: top up with the most promising unfinished ones
+        while frontier and finished < max_beams:
+            (neg_logprob, _, level, node, _) = heapq.heappop(frontier)
+            if level == 0:
+                continue
+            stats.beam()
+            yield (math.exp(-neg_logprob), tree.text(node), level - 1)
+            finished += 1
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        stats.finish()
+
+async def async_parallel_get_logprobs(backend, session, request_prompt):
+    cache, key, logprobs = cached_logprobs(backend, request_prompt)
+    if logprobs is not None:
+        return (logprobs, [])
+
+    logprobs = await backend.async_get_logprobs(session, request_prompt)
+    store_logprobs(cache, key, logprobs)
+    return (logprobs, [])
+
+async def async_parallel_get_logprobs_batch(backend, session, request_prompts, length=1):
+    if length > 1 and backend.supports_continuation:
+        results, misses = batch_misses(backend, request_prompts)
+        following = [[] for _ in request_prompts]
+        if misses:
+            batch = await backend.async_get_continuation_batch(session, [ request_prompts[i] for i, _, _ in misses ], length)
+            store_continuations(backend, request_prompts, misses, batch, results, following)
+        return list(zip(results, following))
+
+    if len(request_prompts) == 1 or not backend.supports_batching:
+        return [ await async_parallel_get_logprobs(backend, session, request_prompt) for request_prompt in request_prompts ]
+
+    results, misses = batch_misses(backend, request_prompts)
+    if misses:
+        batch = await backend.async_get_logprobs_batch(session, [ request_prompts[i] for i, _, _ in misses ])
+        for (i, cache, key), logprobs in zip(misses, batch):
+            store_logprobs(cache, key, logprobs)
+            results[i] = logprobs
+
+    return [ (logprobs, []) for logprobs in results ]
+
+async def async_lloom_search(initial_prompt, max_depth, max_beams, stop_tokens, initial_cutoff, multiplier, maxsplits, concurrency=64, tree=None, batch_size=None, stats=None, cancel=None, deadline=None, max_requests=None, backend=None):
+    # asyncio twin of parallel_lloom_search: in-flight requests are bounded by a semaphore instead of a thread count
+    import asyncio
+
+    deadline_at = search_deadline(deadline)
+    stats = stats if stats is not None else SearchStats()
+    # resolves the cache key's model name before the event loop depends on it
+    backend = open_backend(1, backend)
+    tree = search_tree(backend, tree, initial_prompt)
+    stops = StopTracker(tree, stop_tokens)
+    batch_size = (batch_size or LLOOM_BATCH_SIZE) if backend.supports_batching else 1
+    done_beams = 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with backend.async_session(concurrency) as session:
+        # beams waiting to be sent as (acc, level, tree node, queued at), in-flight senders, how many beams
+        # are queued or in flight, how many requests hold a semaphore slot and the beams those requests
+        # carry (by beam, two beams can be on the same node at once)
+        queue = deque()
+        futures = set()
+        outstanding = 0
+        in_flight = 0
+        requests = 0
+        sending = {}
+
+        async def send():
+            nonlocal in_flight, requests
+            # each queued beam gets a sender; whichever sender wins a semaphore slot takes everything
+            # that queued up in the meantime (up to batch_size), the ones left with nothing just return
+            async with semaphore:
+                if (max_requests is not None and requests >= max_requests) or interrupted(cancel, deadline_at):
+                    return []
+                batch = [ queue.popleft() for _ in range(min(batch_size, len(queue))) ]
+                if not batch:
+                    return []
+                request_prompts = beam_prompts(tree, [ node for acc, level, node, queued_at in batch ])
+                length = max(lookahead(node, level, max_depth, initial_cutoff, multiplier, maxsplits) for acc, level, node, queued_at in batch)
+                requests += 1
+                in_flight += 1
+                for beam in batch:
+                    sending[id(beam)] = beam
+                stats.dispatched(in_flight, concurrency)
+                record = stats.begin(len(request_prompts), batch[0][3])
+                try:
+                    results = await async_parallel_get_logprobs_batch(backend, session, request_prompts, length)
+                finally:
+                    stats.end(record)
+                    in_flight -= 1
+                    for beam in batch:
+                        del sending[id(beam)]
+                return list(zip(batch, results))
+
+        async def known(beam):
+            return [ (beam, (beam[2].logprobs, [])) ]
+
+        def submit(acc, level, node):
+            nonlocal outstanding
+            outstanding += 1
+            if node.logprobs is not None:
+                futures.add(asyncio.ensure_future(known((acc, level, node, None))))
+                return
+            queue.append((acc, level, node, time.time()))
+            futures.add(asyncio.ensure_future(send()))
+
+        submit(0.0, 0, tree.root)
+
+        try:
+            while futures and not interrupted(cancel, deadline_at):
+                done, _ = await asyncio.wait(futures, timeout=wait_timeout(cancel, deadline_at), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    for (acc, level, node, _), (logprobs, following) in future.result():
+                        room = max_beams - done_beams - outstanding if max_beams > 0 else None
+                        for logprob_choice, child, text in expand_beam(tree, node, level, logprobs, following, stats, max_depth, stops, initial_cutoff * multiplier ** level, maxsplits, room):
+                            if text is not None:
+                                stats.beam()
+                                yield (acc + logprob_choice.probability, text, level)
+                                done_beams += 1
+                            else:
+                                submit(acc + logprob_choice.probability, level + 1, child)
+
+                        outstanding -= 1
+
+                    futures.discard(future)
+
+            # stopped early: whatever was still queued or in flight is the best there is
+            pending = [ (acc, level, node) for acc, level, node, queued_at in list(queue) + list(sending.values()) ]
+            for beam in unfinished_beams(tree, pending, max_beams, done_beams):
+                stats.beam()
+                yield beam
+        finally:
+            # consumer stopped early or a request failed: don't leave requests running
+            queue.clear()
+            for future in futures:
+                future.cancel()
+            # let the cancelled requests unwind before the session they use is closed
+            await asyncio.gather(*futures, return_exceptions=True)
+            stats.finish()
+
+def iterate_async_search(search):
+    # drive an async search generator from synchronous code (Streamlit, scripts)
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(search.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(search.aclose())
+        loop.close()
+
+def lloom_search(*args, mode='breadth', **kwargs):
+    if mode == 'best':
+        return best_first_lloom_search(*args, **kwargs)
+    # set LLOOM_ASYNC to run the scripts on the asyncio engine, the last argument becomes the semaphore size
+    if os.getenv('LLOOM_ASYNC') is not None:
+        return iterate_async_search(async_lloom_search(*args, **kwargs))
+    return parallel_lloom_search(*args, **kwargs)
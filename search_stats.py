@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import defaultdict
+
+# Append one JSON line per backend request (plus a summary per search) to this file
+LLOOM_TRACE_PATH = os.getenv('LLOOM_TRACE_PATH')
+
+# the request being timed on this thread or asyncio task, so backends and the cache can report into it
+current_request = contextvars.ContextVar('current_request', default=None)
+
+def report_server_timings(server_ms):
+    # called by backends whose responses say how long the server spent on them
+    record = current_request.get()
+    if record is not None and server_ms is not None:
+        record['server_ms'] = record.get('server_ms', 0.0) + server_ms
+
+def report_overload():
+    # called by backends each time the server answered 429/503 and the request had to be retried
+    record = current_request.get()
+    if record is not None:
+        record['retries'] = record.get('retries', 0) + 1
+
+def report_cache_lookup(hit):
+    record = current_request.get()
+    if record is not None:
+        record['cache_hits' if hit else 'cache_misses'] += 1
+
+class SearchStats:
+    # Timings for one search: per request queue wait, network and server time, fan-out per depth,
+    # cache hits and how many request slots were busy. Safe to share between worker threads.
+
+    def __init__(self, trace_path=LLOOM_TRACE_PATH):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.requests = []
+        # depth -> [beams expanded, children spawned]
+        self.fanout = defaultdict(lambda: [0, 0])
+        self.tree_hits = 0
+        self.beams = 0
+        self.occupancy = []
+        self.capacity = 0
+        self.trace = open(trace_path, 'a') if trace_path else None
+
+    def begin(self, prompts, queued_at):
+        # call from the thread or task that makes the request, returns the record to pass to end()
+        record = { 'start': time.time(), 'queued_at': queued_at, 'prompts': prompts, 'cache_hits': 0, 'cache_misses': 0 }
+        record['token'] = current_request.set(record)
+        return record
+
+    def end(self, record):
+        record['end'] = time.time()
+        current_request.reset(record.pop('token'))
+        entry = {
+            'start': record['start'],
+            'prompts': record['prompts'],
+            'queue_ms': (record['start'] - record['queued_at']) * 1000,
+            # the whole call, cache lookups included; with every prompt cached there is no network at all
+            'network_ms': (record['end'] - record['start']) * 1000 if record['cache_misses'] else 0.0,
+            'server_ms': record.get('server_ms'),
+            'cache_hits': record['cache_hits'],
+            'cache_misses': record['cache_misses'],
+            'retries': record.get('retries', 0),
+        }
+        with self.lock:
+            self.requests.append(entry)
+            if self.trace is not None:
+                self.trace.write(json.dumps(dict(entry, event='request')) + '\n')
+
+    def expanded(self, level, children, known=False):
+        with self.lock:
+            self.fanout[level][0] += 1
+            self.fanout[level][1] += children
+            if known:
+                self.tree_hits += 1
+
+    def beam(self):
+        with self.lock:
+            self.beams += 1
+
+    def dispatched(self, in_flight, capacity):
+        # sampled every time a request is sent
+        with self.lock:
+            self.occupancy.append(in_flight)
+            self.capacity = max(self.capacity, capacity)
+
+    def finish(self):
+        if self.finished is not None:
+            return
+        self.finished = time.time()
+        if self.trace is not None:
+            self.trace.write(json.dumps(dict(self.summary(), event='summary')) + '\n')
+            self.trace.close()
+            self.trace = None
+
+    def summary(self):
+        import numpy as np
+
+        with self.lock:
+            elapsed = (self.finished or time.time()) - self.started
+            network = [ r for r in self.requests if r['cache_misses'] ]
+            latencies = np.array([ r['network_ms'] for r in network ]) if network else np.zeros(1)
+            queue = np.array([ r['queue_ms'] for r in self.requests ]) if self.requests else np.zeros(1)
+            server = [ r['server_ms'] for r in network if r['server_ms'] is not None ]
+            # every expanded beam is one generated token, however it was answered
+            tokens = sum(expanded for expanded, children in self.fanout.values())
+            return {
+                'seconds': elapsed,
+                'beams': self.beams,
+                'tokens': tokens,
+                'tokens_per_sec': tokens / elapsed if elapsed > 0 else 0.0,
+                'requests': len(network),
+                'requests_per_sec': len(network) / elapsed if elapsed > 0 else 0.0,
+                'prompts_per_request': sum(r['cache_misses'] for r in network) / len(network) if network else 0.0,
+                'cache_hits': sum(r['cache_hits'] for r in self.requests),
+                'retries': sum(r['retries'] for r in self.requests),
+                'tree_hits': self.tree_hits,
+                'queue_ms_mean': float(queue.mean()),
+                'network_ms_p50': float(np.percentile(latencies, 50)),
+                'network_ms_p95': float(np.percentile(latencies, 95)),
+                'network_ms_p99': float(np.percentile(latencies, 99)),
+                'server_ms_mean': sum(server) / len(server) if server else None,
+                'occupancy_mean': sum(self.occupancy) / len(self.occupancy) if self.occupancy else 0.0,
+                'occupancy_max': max(self.occupancy) if self.occupancy else 0,
+                'capacity': self.capacity,
+                # depth -> average children per expanded beam
+                'fanout': { level: children / expanded for level, (expanded, children) in sorted(self.fanout.items()) },
+            }
@@ -0,0 +1,92 @@
+class TokenNode:
+    __slots__ = ('token', 'token_id', 'probability', 'parent', 'children', 'logprobs')
+
+    def __init__(self, token='', probability=1.0, parent=None, token_id=None):
+        self.token = token
+        self.token_id = token_id
+        self.probability = probability
+        self.parent = parent
+        # token id (token text when the id isn't known) -> TokenNode, different ids can share a text
+        self.children = {}
+        # the backend's next-token distribution, once this node has been expanded
+        self.logprobs = None
+
+class TokenTree:
+    # Every prefix a search has explored, rooted at the story it started from. Keeping it
+    # between searches means already-expanded nodes never have to be requested again.
+
+    def __init__(self, prompt, root=None, prompt_ids=None):
+        self.prompt = prompt
+        self.root = root if root is not None else TokenNode()
+        # the prompt tokenized once by the server, None when searching on text
+        self.prompt_ids = prompt_ids
+
+    def child(self, node, token, probability, token_id=None):
+        key = token_id if token_id is not None else token
+        if key not in node.children:
+            node.children[key] = TokenNode(token, probability, node, token_id)
+        return node.children[key]
+
+    def token_ids(self, node):
+        # prompt ids followed by the ids along the path to node, or None if any of them is unknown
+        if self.prompt_ids is None:
+            return None
+        ids = []
+        while node.parent is not None:
+            if node.token_id is None:
+                return None
+            ids.append(node.token_id)
+            node = node.parent
+        return self.prompt_ids + ids[::-1]
+
+    def suffix(self, node):
+        # the text the search generated on the way to node, without the prompt
+        tokens = []
+        while node is not None:
+            tokens.append(node.token)
+            node = node.parent
+        return ''.join(reversed(tokens))
+
+    def text(self, node):
+        # beams are only nodes, their full text is put together when a request or a result needs it
+        return self.prompt + self.suffix(node)
+
+    def find(self, text):
+        # the node whose full text is exactly `text`, or None if the story left the tree mid-token
+        if not text.startswith(self.prompt):
+            return None
+
+        # tokens can be prefixes of each other (" the", " then") so this is a depth-first walk
+        stack = [(self.root, len(self.prompt))]
+        while stack:
+            node, offset = stack.pop()
+            if offset == len(text):
+                return node
+            for child in node.children.values():
+                if child.token and text.startswith(child.token, offset):
+                    stack.append((child, offset + len(child.token)))
+        return None
+
+    def reroot(self, new_prompt):
+        # keep only the subtree below the accepted text, returns None when there is nothing to reuse
+        node = self.find(new_prompt)
+        if node is None:
+            return None
+
+        prompt_ids = self.token_ids(node)
+        node.parent = None
+        node.token = ''
+        node.probability = 1.0
+        return TokenTree(new_prompt, node, prompt_ids)
+
+    def size(self):
+        nodes = 0
+        expanded = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            if node.logprobs is not None:
+                expanded += 1
+            stack.extend(node.children.values())
+        return nodes, expanded
@@ -1,60 +1,80 @@
-from graphviz import Digraph
-from collections import defaultdict
-
-def find_common_prefix(strings):
-    if not strings:
-        return "", []
-    if len(strings) == 1:
-        return strings[0], []
-
-    prefix = strings[0]
-    for s in strings[1:]:
-        i = 0
-        while i < len(prefix) and i < len(s) and prefix[i] == s[i]:
-            i += 1
-        prefix = prefix[:i]
-        if not prefix:
-            break
-        
-    if ' ' in prefix:
-        # stop at the last space
-        prefix = prefix.rsplit(' ', 1)[0]
-
-    remaining = [s[len(prefix):].strip() for s in strings if s[len(prefix):].strip()]
-    return prefix, remaining
-
-def visualize_common_prefixes(strings):
+import os
+
+# Branches holding less than this share of the total probability are folded into one "+N more" node (0: draw everything)
+LLOOM_VIZ_MIN_MASS = float(os.getenv('LLOOM_VIZ_MIN_MASS', 0.0))
+
+class TrieNode:
+    __slots__ = ('children', 'mass', 'ends')
+
+    def __init__(self):
+        self.children = {}
+        self.mass = 0.0
+        self.ends = 0
+
+def build_word_trie(strings, probs=None):
+    # one pass over the words of every string, each node knows the probability mass of the strings below it
+    root = TrieNode()
+    for i, s in enumerate(strings):
+        weight = 1.0 if probs is None else probs[i]
+        node = root
+        node.mass += weight
+        for word in s.split():
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = TrieNode()
+            child.mass += weight
+            node = child
+        node.ends += 1
+    return root
+
+def visualize_common_prefixes(strings, probs=None, min_mass=None):
+    from graphviz import Digraph
+
     graph = Digraph()
     graph.attr(rankdir='LR')  # Set the direction to left-to-right
-    
-    def add_nodes_and_edges(strings, parent=None, level=0):
-        if not strings:
-            return
+    # set once here, quoting attributes on every node is most of the time graphviz takes
+    graph.attr('node', shape='box', style='filled', fillcolor='lightgrey', fontsize='12')
+    if min_mass is None:
+        min_mass = LLOOM_VIZ_MIN_MASS
+
+    # Add "[start]" prefix to each string
+    root = TrieNode()
+    root.children['[start]'] = build_word_trie(strings, probs)
+    cutoff = root.children['[start]'].mass * min_mass
 
-        prefix, remainder = find_common_prefix(strings)
+    node_ids = 0
+    stack = [ (None, word, child) for word, child in root.children.items() ]
+    while stack:
+        parent, word, node = stack.pop()
+        node_id = f"n{node_ids}"
+        node_ids += 1
+        if node is None:
+            # everything pruned below parent, word is how many branches that was
+            graph.node(node_id, f"+{word} more", style='dashed', fontsize='10')
+            graph.edge(parent, node_id)
+            continue
 
-        if prefix:
-            node_label = prefix.strip()
-            node_id = f"{level}-{node_label}"
-            graph.node(node_id, node_label, shape='box', style='filled', fillcolor='lightgrey', fontsize='12')
-            if parent and parent != node_label:  # Avoid self-looping edge
-                graph.edge(parent, node_id)
-                print(level, prefix, ':', parent, '=>', node_label)
+        # words nobody branches off from or stops at share a box with the one before them
+        words = [word]
+        while len(node.children) == 1 and node.ends == 0:
+            word, node = next(iter(node.children.items()))
+            words.append(word)
 
-        if remainder:
-            child_groups = defaultdict(list)
-            for s in remainder:
-                child_groups[s.split()[0]].append(s)
+        # ids are just a counter, so the same words on different branches stay separate nodes
+        graph.node(node_id, ' '.join(words))
+        if parent is not None:
+            graph.edge(parent, node_id)
 
-            for group in child_groups.values():
-                add_nodes_and_edges(group, node_id, level+1)
+        kept = [ (word, child) for word, child in node.children.items() if child.mass >= cutoff ]
+        if len(kept) < len(node.children):
+            stack.append((node_id, len(node.children) - len(kept), None))
+        # reversed so the stack pops children in the order they were first seen
+        for word, child in reversed(kept):
+            stack.append((node_id, word, child))
 
-    # Add "[start]" prefix to each string
-    prefixed_strings = ["[start] " + s for s in strings]
-    add_nodes_and_edges(prefixed_strings, None)
     return graph
 
 if __name__ == "__main__":
     strings = ["There was once", "There was a", "One sunny"]
     graph = visualize_common_prefixes(strings)
-    graph.render('common_prefixes', format='png', cleanup=True)
\ No newline at end of file
+    graph.render('common_prefixes', format='png', cleanup=True)